@@ -1,44 +1,171 @@
+import base64
+from contextlib import asynccontextmanager
+
 import httpx
 
+# Module-level clients; `pooled` swaps in shared ones so that many calls in
+# one process (batch mode) reuse connections instead of opening new ones.
+_http = httpx
+_async_http = None
+
+
+@asynccontextmanager
+async def pooled(max_connections=20):
+    """Route every API call made inside the block through shared connection pools."""
+    global _http, _async_http
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    with httpx.Client(limits=limits) as sync_client:
+        async with httpx.AsyncClient(limits=limits) as shared:
+            _http, _async_http = sync_client, shared
+            try:
+                yield
+            finally:
+                _http, _async_http = httpx, None
+
+
+@asynccontextmanager
+async def async_client():
+    if _async_http is not None:
+        yield _async_http
+    else:
+        async with httpx.AsyncClient() as client:
+            yield client
+
 
 async def report_usage(from_id, to_id, bytes_sent, server):
-    async with httpx.AsyncClient() as client:
+    async with async_client() as client:
         payload = {"from_id": from_id, "to_id": to_id, "bytes_sent": bytes_sent}
         response = await client.post(f"{server}/report", json=payload)
         response.raise_for_status()
         return response.json()
 
 
+async def report_objects(reservation_id, from_id, objects, server):
+    async with async_client() as client:
+        payload = {"requester": from_id, "objects": objects}
+        response = await client.post(f"{server}/reservations/{reservation_id}/objects", json=payload)
+        response.raise_for_status()
+        return response.json()
+
+
+async def announce_candidates(reservation_id, from_id, candidates, connection_id, server):
+    async with async_client() as client:
+        payload = {"requester": from_id, "candidates": candidates, "connection_id": connection_id}
+        response = await client.post(f"{server}/requests/{reservation_id}/candidates", json=payload)
+        response.raise_for_status()
+        return response.json()
+
+
+async def list_candidates(client_id, server):
+    async with async_client() as client:
+        response = await client.get(f"{server}/candidates", params={"for": client_id})
+        response.raise_for_status()
+        return response.json()
+
+
+async def list_reservations(client_id, server):
+    async with async_client() as client:
+        response = await client.get(f"{server}/reservations", params={"for": client_id})
+        response.raise_for_status()
+        return response.json()
+
+
 def register(client_id, endpoint, space, server):
     payload = {"id": client_id, "endpoint": endpoint, "available_space": space}
-    response = httpx.post(f"{server}/register", json=payload)
+    response = _http.post(f"{server}/register", json=payload)
     response.raise_for_status()
     return response.json()
 
 
 def list_offers(min_space, server):
-    response = httpx.get(f"{server}/offers", params={"min_space": min_space})
+    response = _http.get(f"{server}/offers", params={"min_space": min_space})
     response.raise_for_status()
     return response.json()
 
 
+class OffersMirror:
+    """Local copy of the server's peer table, kept current with delta polls.
+
+    Each `refresh` sends the last seen version as `since` and as an ETag, so
+    an unchanged table costs a 304 and a changed one only the churn.
+    """
+
+    def __init__(self, server, min_space=0):
+        self.server = server
+        self.min_space = min_space
+        self.peers = {}
+        self.version = 0
+        self.etag = None
+
+    def refresh(self):
+        """Poll the server; return True if the mirror changed."""
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        response = _http.get(
+            f"{self.server}/offers",
+            params={"min_space": self.min_space, "since": self.version},
+            headers=headers,
+        )
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        delta = response.json()
+        if delta["reset"]:
+            self.peers.clear()
+        for peer_id in delta["removed"]:
+            self.peers.pop(peer_id, None)
+        for peer in delta["changed"]:
+            self.peers[peer["id"]] = peer
+        self.version = delta["version"]
+        self.etag = response.headers.get("ETag")
+        return bool(delta["reset"] or delta["removed"] or delta["changed"])
+
+    def offers(self):
+        return list(self.peers.values())
+
+
 def reserve(from_id, to_id, amount, server):
     payload = {"from_id": from_id, "to_id": to_id, "amount": amount}
-    response = httpx.post(f"{server}/reserve", json=payload)
+    response = _http.post(f"{server}/reserve", json=payload)
     response.raise_for_status()
     return response.json()
 
 
 def list_requests(client_id, server):
-    response = httpx.get(f"{server}/requests", params={"for": client_id})
+    response = _http.get(f"{server}/requests", params={"for": client_id})
     response.raise_for_status()
     return response.json()
 
 
 def approve_reservation(reservation_id, secret_data, server):
-    response = httpx.post(
+    response = _http.post(
         f"{server}/requests/{reservation_id}/approve",
         json={"secret_info": secret_data},
     )
     response.raise_for_status()
     return response.json()
+
+
+
+def issue_challenges(reservation_id, count, server):
+    response = _http.post(
+        f"{server}/challenges",
+        json={"reservation_id": reservation_id, "count": count},
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def list_challenges(client_id, server):
+    response = _http.get(f"{server}/challenges", params={"for": client_id})
+    response.raise_for_status()
+    return response.json()
+
+
+def answer_challenge(challenge_id, leaf, proof, server):
+    payload = {
+        "leaf": base64.b64encode(leaf).decode(),
+        "proof": [h.hex() for h in proof],
+    }
+    response = _http.post(f"{server}/challenges/{challenge_id}/answer", json=payload)
+    response.raise_for_status()
+    return response.json()
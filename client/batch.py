@@ -0,0 +1,175 @@
+import asyncio
+import json
+import re
+import time
+from pathlib import Path
+from typing import Dict, List, TextIO
+
+import api_client
+from p2p import get_secret_data
+from p2p_ops import close_sessions, p2p_connect_and_send, p2p_retrieve
+from storage import ensure_storage_dir
+from udp import parse_endpoint
+
+# "${op_id.field}" in an argument is replaced by that field of op_id's result
+REFERENCE = re.compile(r"\$\{([^.}]+)\.([^}]+)\}")
+
+
+async def _register(args, server):
+    if args.get("storage_dir"):
+        ensure_storage_dir(Path(args["storage_dir"]))
+    return await asyncio.to_thread(api_client.register, args["client_id"], args["endpoint"], args["space"], server)
+
+
+async def _offers(args, server):
+    return await asyncio.to_thread(api_client.list_offers, args.get("min_space", 1), server)
+
+
+async def _reserve(args, server):
+    return await asyncio.to_thread(api_client.reserve, args["from_id"], args["to_id"], args["amount"], server)
+
+
+async def _requests(args, server):
+    return await asyncio.to_thread(api_client.list_requests, args["client_id"], server)
+
+
+async def _approve(args, server):
+    # Announces the secret only; run `serve` separately to accept the uploads
+    if args.get("storage_dir"):
+        ensure_storage_dir(Path(args["storage_dir"]))
+    secret_data = await asyncio.to_thread(get_secret_data, args.get("local_port", 12345), args["reservation_id"])
+    await asyncio.to_thread(api_client.approve_reservation, args["reservation_id"], secret_data, server)
+    return {"status": "approved", "peer_id": secret_data["peer_id"]}
+
+
+async def _p2p_connect(args, server):
+    paths = args.get("file_path") or []
+    if isinstance(paths, str):
+        paths = [paths]
+    count, bytes_sent = await p2p_connect_and_send(
+        args["reservation_id"], args["client_id"], args.get("local_port", 12345),
+        [Path(p) for p in paths], server, api_client.report_usage,
+        args.get("udp", False), parse_endpoint(args.get("stun")),
+    )
+    return {"files": count, "bytes": bytes_sent}
+
+
+async def _retrieve(args, server):
+    received = await p2p_retrieve(
+        args["reservation_id"], args["client_id"], args.get("local_port", 12345),
+        args["name"], Path(args["output"]), server,
+        args.get("offset", 0), args.get("length"), args.get("parallel", 4),
+        args.get("udp", False), parse_endpoint(args.get("stun")),
+    )
+    return {"bytes": received}
+
+
+OPERATIONS = {
+    "register": _register,
+    "offers": _offers,
+    "reserve": _reserve,
+    "requests": _requests,
+    "approve": _approve,
+    "p2p-connect": _p2p_connect,
+    "retrieve": _retrieve,
+}
+
+
+def parse_operations(lines) -> List[Dict]:
+    """Parse JSONL operations; each gets an `id` (its line number if absent)."""
+    ops = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        op = json.loads(line)
+        op.setdefault("id", str(lineno))
+        op["id"] = str(op["id"])
+        if op.get("op") not in OPERATIONS:
+            raise ValueError(f"Line {lineno}: unknown operation {op.get('op')!r}")
+        ops.append(op)
+    ids = [op["id"] for op in ops]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Operation ids must be unique")
+    return ops
+
+
+def _dependencies(op: Dict) -> List[str]:
+    refs = REFERENCE.findall(json.dumps(op.get("args", {})))
+    return [str(d) for d in op.get("after", [])] + [op_id for op_id, _ in refs]
+
+
+def _check_graph(ops: List[Dict]):
+    deps = {op["id"]: set(_dependencies(op)) for op in ops}
+    for op_id, needs in deps.items():
+        missing = needs - deps.keys()
+        if missing:
+            raise ValueError(f"Operation {op_id} depends on unknown ids: {sorted(missing)}")
+    # Kahn's algorithm: anything left unresolved sits on a cycle
+    waiting = {op_id: len(needs) for op_id, needs in deps.items()}
+    dependents: Dict[str, List[str]] = {op_id: [] for op_id in deps}
+    for op_id, needs in deps.items():
+        for need in needs:
+            dependents[need].append(op_id)
+    ready = [op_id for op_id, n in waiting.items() if n == 0]
+    resolved = 0
+    while ready:
+        op_id = ready.pop()
+        resolved += 1
+        for other in dependents[op_id]:
+            waiting[other] -= 1
+            if waiting[other] == 0:
+                ready.append(other)
+    if resolved != len(deps):
+        raise ValueError(f"Dependency cycle among: {sorted(k for k, n in waiting.items() if n)}")
+
+
+def _resolve(value, results: Dict[str, Dict]):
+    if isinstance(value, str):
+        whole = REFERENCE.fullmatch(value)
+        if whole:
+            return results[whole.group(1)]["result"][whole.group(2)]
+        return REFERENCE.sub(lambda m: str(results[m.group(1)]["result"][m.group(2)]), value)
+    if isinstance(value, list):
+        return [_resolve(v, results) for v in value]
+    if isinstance(value, dict):
+        return {k: _resolve(v, results) for k, v in value.items()}
+    return value
+
+
+async def run_batch(ops: List[Dict], out: TextIO, server: str, concurrency: int = 16) -> Dict[str, Dict]:
+    """Run `ops` concurrently (at most `concurrency` at once), respecting
+    `after` lists and `${id.field}` references, and write one JSON result
+    line per operation to `out` as each finishes.
+    """
+    _check_graph(ops)
+    results: Dict[str, Dict] = {}
+    done = {op["id"]: asyncio.Event() for op in ops}
+    limit = asyncio.Semaphore(concurrency)
+
+    async def _run(op: Dict):
+        started = time.monotonic()
+        record = {"id": op["id"], "op": op["op"]}
+        try:
+            for dep in _dependencies(op):
+                await done[dep].wait()
+                if not results[dep]["ok"]:
+                    raise RuntimeError(f"dependency {dep} failed")
+            args = _resolve(op.get("args", {}), results)
+            async with limit:
+                result = await OPERATIONS[op["op"]](args, args.get("server", server))
+            record.update(ok=True, result=result)
+        except Exception as e:
+            record.update(ok=False, error=str(e) or type(e).__name__)
+        record["elapsed"] = round(time.monotonic() - started, 3)
+        results[op["id"]] = record
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+        done[op["id"]].set()
+
+    async with api_client.pooled(max_connections=concurrency):
+        try:
+            await asyncio.gather(*[_run(op) for op in ops])
+        finally:
+            await close_sessions()
+    return results
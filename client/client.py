@@ -1,6 +1,8 @@
 import asyncio
 import socket
+import sys
 from pathlib import Path
+from typing import List
 
 import typer
 
@@ -11,10 +13,20 @@ from api_client import (
     reserve as api_reserve,
     list_requests as api_list_requests,
     approve_reservation,
+    issue_challenges,
 )
 from storage import ensure_storage_dir, validate_file_path
-from p2p_ops import p2p_connect_and_send, p2p_receive
+from p2p_ops import (
+    answer_challenges,
+    close_sessions,
+    p2p_connect_and_send,
+    p2p_receive,
+    p2p_retrieve,
+    p2p_serve,
+)
 from p2p import get_secret_data
+from udp import parse_endpoint
+from batch import parse_operations, run_batch
 
 app = typer.Typer(help="Minimal P2P Storage Client")
 
@@ -101,7 +113,7 @@ def approve(
         raise typer.Abort()
 
     ensure_storage_dir(storage_dir)
-    secret_data = get_secret_data(local_port)
+    secret_data = get_secret_data(local_port, reservation_id)
     approve_reservation(reservation_id, secret_data, server)
     typer.echo("Secret announced:")
     typer.echo(secret_data)
@@ -111,30 +123,70 @@ def approve(
     typer.echo(f"P2P connection established; storing into {storage_dir}")
 
 
+@app.command()
+def serve(
+    local_port: int = typer.Option(12345, help="Local port to listen on"),
+    storage_dir: Path = typer.Option(
+        ..., prompt="Folder to host incoming files"
+    ),
+    quota: int = typer.Option(
+        None, help="MB to store for peers (default: the space registered for --client-id)"
+    ),
+    udp: bool = typer.Option(False, help="Also accept hole-punched UDP sessions"),
+    client_id: str = typer.Option(..., help="Your peer ID; only reservations approved for it are served"),
+    server: str = typer.Option("http://localhost:8000", help="Server URL"),
+) -> None:
+    """Listen for peers and store the files they upload."""
+    if quota is None:
+        peer = next((p for p in api_list_offers(0, server) if p["id"] == client_id), None)
+        if peer is None:
+            typer.echo(f"Peer {client_id} is not registered")
+            raise typer.Exit(1)
+        quota = peer["free_space"]
+    typer.echo(f"Serving on port {local_port}; storing up to {quota} MB into {storage_dir}")
+
+    def _on_batch(count: int, total: int) -> None:
+        typer.echo(f"Stored {count} files ({total} bytes)")
+
+    try:
+        asyncio.run(p2p_serve(local_port, storage_dir, quota, _on_batch, udp, client_id, server))
+    except KeyboardInterrupt:
+        pass
+
+
 @app.command()
 def p2p_connect(
     reservation_id: str = typer.Argument(..., help="Reservation ID"),
     client_id: str = typer.Option(..., help="Your client ID"),
     local_port: int = typer.Option(12345, help="Local port to use"),
-    file_path: Path = typer.Option(
-        None, help="Optional path to file to send"
+    file_path: List[Path] = typer.Option(
+        None, help="Optional file or directory to send; repeat to send several"
     ),
+    udp: bool = typer.Option(False, help="Connect over hole-punched UDP instead of TCP"),
+    stun: str = typer.Option(None, help="STUN server host:port for the UDP candidates"),
     server: str = typer.Option("http://localhost:8000", help="Server URL"),
 ) -> None:
-    """Establish a P2P connection and optionally send a file."""
+    """Establish a P2P connection and optionally send files over one session."""
     async def _run() -> None:
-        if file_path:
+        for path in file_path or []:
             try:
-                validate_file_path(file_path)
+                validate_file_path(path)
             except FileNotFoundError as e:
                 typer.echo(str(e))
                 return
         try:
-            await p2p_connect_and_send(reservation_id, client_id, local_port, file_path, server, report_usage)
+            count, bytes_sent = await p2p_connect_and_send(
+                reservation_id, client_id, local_port, file_path, server, report_usage,
+                udp, parse_endpoint(stun),
+            )
+            if file_path:
+                typer.echo(f"Sent {count} files ({bytes_sent} bytes).")
             typer.echo("P2P operation completed.")
         except Exception as e:
             typer.echo(f"P2P error: {e}")
             raise typer.Exit(1)
+        finally:
+            await close_sessions()
 
     try:
         asyncio.run(_run())
@@ -142,6 +194,109 @@ def p2p_connect(
         typer.echo(f"P2P error: {e}")
         raise typer.Exit(1)
 
+@app.command()
+def retrieve(
+    reservation_id: str = typer.Argument(..., help="Reservation ID"),
+    client_id: str = typer.Option(..., help="Your client ID"),
+    name: str = typer.Option(..., help="Name of the stored file, e.g. photos/a.jpg"),
+    output: Path = typer.Option(..., help="Where to write the downloaded bytes"),
+    offset: int = typer.Option(0, min=0, help="First byte to download"),
+    length: int = typer.Option(None, min=0, help="Number of bytes to download (default: to the end)"),
+    parallel: int = typer.Option(4, min=1, help="Concurrent range fetches"),
+    local_port: int = typer.Option(12345, help="Local port to use"),
+    udp: bool = typer.Option(False, help="Connect over hole-punched UDP instead of TCP"),
+    stun: str = typer.Option(None, help="STUN server host:port for the UDP candidates"),
+    server: str = typer.Option("http://localhost:8000", help="Server URL"),
+) -> None:
+    """Download a stored file, or a byte range of it, back from the host."""
+    async def _run() -> int:
+        try:
+            return await p2p_retrieve(
+                reservation_id, client_id, local_port, name, output, server,
+                offset, length, parallel, udp, parse_endpoint(stun),
+            )
+        finally:
+            await close_sessions()
+
+    try:
+        received = asyncio.run(_run())
+    except Exception as e:
+        typer.echo(f"P2P error: {e}")
+        raise typer.Exit(1)
+    typer.echo(f"Retrieved {received} bytes into {output}")
+
+
+@app.command()
+def challenge(
+    reservation_id: str = typer.Argument(..., help="Reservation ID"),
+    count: int = typer.Option(1, min=1, max=100, help="Number of random leaves to challenge"),
+    server: str = typer.Option("http://localhost:8000", help="Server URL"),
+) -> None:
+    """Ask the host of a reservation to prove it still stores the data."""
+    for c in issue_challenges(reservation_id, count, server):
+        typer.echo(f"Challenge {c['challenge_id']}: {c['name']} leaf {c['leaf']}")
+
+
+@app.command("answer-challenges")
+def answer_challenges_cmd(
+    client_id: str = typer.Option(..., help="Your peer ID"),
+    storage_dir: Path = typer.Option(
+        ..., prompt="Folder hosting incoming files"
+    ),
+    server: str = typer.Option("http://localhost:8000", help="Server URL"),
+) -> None:
+    """Answer pending proof-of-storage challenges with Merkle proofs.
+
+    Only for a store that is not being served; `serve` answers them itself.
+    """
+    try:
+        results = answer_challenges(client_id, storage_dir, server)
+    except RuntimeError as e:
+        typer.echo(f"{e}; the running `serve` answers its challenges itself")
+        raise typer.Exit(1)
+    if not results:
+        typer.echo("No pending challenges.")
+        raise typer.Exit()
+    for result in results:
+        typer.echo(f"Challenge {result['challenge_id']}: {result['status']}")
+
+
+@app.command()
+def batch(
+    ops_file: Path = typer.Argument(..., help="JSONL file of operations ('-' for stdin)"),
+    output: Path = typer.Option(None, help="Write JSONL results here instead of stdout"),
+    concurrency: int = typer.Option(16, min=1, help="Operations running at the same time"),
+    server: str = typer.Option("http://localhost:8000", help="Server URL"),
+) -> None:
+    """Run many operations from a JSONL file in one process.
+
+    Each line is {"id": ..., "op": ..., "args": {...}, "after": [...]}, where
+    op is register, offers, reserve, requests, approve, p2p-connect or
+    retrieve and args use the option names of that command. A string arg
+    "${id.field}" takes a field from an earlier operation's result.
+    """
+    lines = sys.stdin if str(ops_file) == "-" else ops_file.open()
+    try:
+        ops = parse_operations(lines)
+    except ValueError as e:
+        typer.echo(f"Invalid batch: {e}")
+        raise typer.Exit(1)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+    out = output.open("w") if output else sys.stdout
+    try:
+        results = asyncio.run(run_batch(ops, out, server, concurrency))
+    except ValueError as e:
+        typer.echo(f"Invalid batch: {e}")
+        raise typer.Exit(1)
+    finally:
+        if output:
+            out.close()
+    if not all(r["ok"] for r in results.values()):
+        raise typer.Exit(1)
+
 
 if __name__ == "__main__":
     app()
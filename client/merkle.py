@@ -0,0 +1,84 @@
+import hashlib
+from typing import List, Sequence
+
+LEAF_SIZE = 4096
+HASH_SIZE = 32
+
+
+def leaf_hash(data: bytes) -> bytes:
+    return hashlib.sha256(b"\x00" + data).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+class MerkleBuilder:
+    """Incrementally hash data into LEAF_SIZE leaves as it is written."""
+
+    def __init__(self):
+        self.leaves: List[bytes] = []
+        self._partial = bytearray()
+        self._finished = False
+
+    def update(self, data: bytes):
+        self._partial += data
+        full = len(self._partial) - len(self._partial) % LEAF_SIZE
+        for i in range(0, full, LEAF_SIZE):
+            self.leaves.append(leaf_hash(bytes(self._partial[i:i + LEAF_SIZE])))
+        del self._partial[:full]
+
+    def finish(self) -> List[bytes]:
+        """Hash the trailing partial leaf; an empty object has one empty leaf."""
+        if not self._finished:
+            if self._partial or not self.leaves:
+                self.leaves.append(leaf_hash(bytes(self._partial)))
+            self._partial.clear()
+            self._finished = True
+        return self.leaves
+
+
+def _next_level(level: Sequence[bytes]) -> List[bytes]:
+    # An odd node out is promoted unchanged to the next level
+    up = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        up.append(level[-1])
+    return up
+
+
+def root(leaves: Sequence[bytes]) -> bytes:
+    level = list(leaves)
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+
+def prove(leaves: Sequence[bytes], index: int) -> List[bytes]:
+    """Return the sibling hashes from leaf `index` up to the root."""
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(level[sibling])
+        level = _next_level(level)
+        index //= 2
+    return proof
+
+
+def verify(root_hash: bytes, leaf: bytes, index: int, leaf_count: int, proof: Sequence[bytes]) -> bool:
+    """Check that `leaf` is leaf `index` of a `leaf_count`-leaf tree with `root_hash`."""
+    if not 0 <= index < leaf_count or len(leaf) > LEAF_SIZE:
+        return False
+    h = leaf_hash(leaf)
+    proof = list(proof)
+    n = leaf_count
+    while n > 1:
+        if index ^ 1 < n:
+            if not proof:
+                return False
+            sibling = proof.pop(0)
+            h = node_hash(h, sibling) if index % 2 == 0 else node_hash(sibling, h)
+        index //= 2
+        n = (n + 1) // 2
+    return not proof and h == root_hash
@@ -1,6 +1,6 @@
+import asyncio
 import upnpy
 import stun
-import httpx
 import socket
 from typing import Dict, List, Optional, Tuple, BinaryIO
 import os
@@ -9,6 +9,10 @@ from cryptography.hazmat.primitives import serialization
 import base64
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
 import hashlib
+import hmac
+import json
+from api_client import async_client
+from udp import candidate_addresses, connection_token, make_candidate, shared_endpoint
 
 class NATTraversal:
     def __init__(self, local_port: int):
@@ -78,7 +82,29 @@ def load_or_create_keypair(keyfile: str = ".peer_private_key"):
     peer_id = hashlib.sha256(public_bytes).hexdigest()
     return private_key, base64.b64encode(public_bytes).decode(), peer_id
 
-def get_secret_data(local_port: int) -> dict:
+def _signed_candidates(ice_candidates) -> str:
+    """Canonical encoding of the candidate list for the secret's signature."""
+    return json.dumps(ice_candidates or [], sort_keys=True, separators=(",", ":"))
+
+def reservation_key(private_key, reservation_id: str) -> str:
+    """Connection key of `reservation_id`, derived from the host's private key.
+
+    The host can recompute it for any reservation without storing it; the
+    requester gets it from the signed secret and proves it holds it with
+    `reservation_proof`.
+    """
+    raw = private_key.private_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PrivateFormat.Raw,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    digest = hmac.new(raw, b"connection-key|" + reservation_id.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+def reservation_proof(connection_key: str, nonce: bytes) -> bytes:
+    return hmac.new(base64.b64decode(connection_key), nonce, hashlib.sha256).digest()
+
+def get_secret_data(local_port: int, reservation_id: str) -> dict:
     """Get connection secret data for NAT traversal, with secure keypair."""
     nat = NATTraversal(local_port)
     private_key, public_key_b64, peer_id = load_or_create_keypair()
@@ -99,10 +125,16 @@ def get_secret_data(local_port: int) -> dict:
         
     local_ip = nat._get_local_ip()
     
-    import secrets
-    connection_key = base64.b64encode(secrets.token_bytes(32)).decode()
+    ice_candidates = [make_candidate(local_ip, local_port, "host")]
+    if (external_ip, external_port) != (local_ip, local_port):
+        ice_candidates.append(make_candidate(external_ip, external_port, "srflx"))
+
+    connection_key = reservation_key(private_key, reservation_id)
     # Prepare the data to be signed (all fields except signature)
-    data_to_sign = f"{peer_id}|{public_key_b64}|{local_ip}:{local_port}|{external_ip}:{external_port}|{connection_key}"
+    data_to_sign = (
+        f"{peer_id}|{public_key_b64}|{local_ip}:{local_port}|{external_ip}:{external_port}|{connection_key}"
+        f"|{_signed_candidates(ice_candidates)}"
+    )
     signature = base64.b64encode(private_key.sign(data_to_sign.encode())).decode()
     return {
         "peer_id": peer_id,
@@ -112,8 +144,9 @@ def get_secret_data(local_port: int) -> dict:
         "public_ip": external_ip,
         "tcp_port": external_port,
         "connection_key": connection_key,
-        # Placeholders for future fields:
-        "ice_candidates": [],
+        # UDP candidates for hole punching
+        "ice_candidates": ice_candidates,
+        # Placeholder for future fields:
         "offer_sdp": "",
         "signature": signature,
     }
@@ -142,7 +175,7 @@ def initialize_nat_traversal(local_port: int) -> Dict:
 
 async def fetch_peer_secret(reservation_id: str, requester_id: str, server: str = "http://localhost:8000") -> Dict:
     """Fetch the peer's connection information from the server and verify signature."""
-    async with httpx.AsyncClient() as client:
+    async with async_client() as client:
         response = await client.get(
             f"{server}/requests/{reservation_id}",
             params={"requester": requester_id}
@@ -150,7 +183,10 @@ async def fetch_peer_secret(reservation_id: str, requester_id: str, server: str
         response.raise_for_status()
         secret_info = response.json()["secret_info"]
         # Verify signature
-        data_to_sign = f"{secret_info['peer_id']}|{secret_info['public_key']}|{secret_info['local_endpoint']}|{secret_info['public_endpoint']}|{secret_info['connection_key']}"
+        data_to_sign = (
+            f"{secret_info['peer_id']}|{secret_info['public_key']}|{secret_info['local_endpoint']}|{secret_info['public_endpoint']}|{secret_info['connection_key']}"
+            f"|{_signed_candidates(secret_info.get('ice_candidates'))}"
+        )
         signature = base64.b64decode(secret_info['signature'])
         public_key_bytes = base64.b64decode(secret_info['public_key'])
         public_key = Ed25519PublicKey.from_public_bytes(public_key_bytes)
@@ -183,6 +219,36 @@ class P2PConnection:
                 self.socket.close()
             raise ConnectionError(f"Failed to connect to peer: {e}")
 
+    async def open_stream(self, secret_data: Dict) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Open an asyncio stream to the peer's public endpoint"""
+        host, port = secret_data["public_endpoint"].split(":")
+        try:
+            return await asyncio.open_connection(host, int(port))
+        except OSError as e:
+            raise ConnectionError(f"Failed to connect to peer: {e}")
+
+    async def open_udp(self, secret_data: Dict, reservation_id: str, stun_server: Optional[Tuple[str, int]] = None, announce=None):
+        """Hole-punch a reliable UDP connection to the peer's ICE candidates.
+
+        The connection gets a random id; it is passed to `announce` with our
+        own candidates so the peer can punch towards us at the same time.
+        Connections from this process share one socket on `local_port`.
+        Returns the connection twice, as (reader, writer).
+        """
+        endpoint = await shared_endpoint(self.local_port)
+        conn = endpoint.connection(connection_token(reservation_id), os.urandom(8))
+        try:
+            candidates = await endpoint.gather_candidates(stun_server, self.nat._get_local_ip())
+            if announce:
+                await announce(candidates, conn.conn_id.hex())
+            await conn.punch(candidate_addresses(secret_data.get("ice_candidates") or []))
+        except BaseException as e:
+            conn.abort()
+            if isinstance(e, ConnectionError):
+                raise ConnectionError(f"Failed to connect to peer over UDP: {e}")
+            raise
+        return conn, conn
+
     def send_data(self, data: BinaryIO, chunk_size: int = 8192) -> int:
         """Stream data over the established connection"""
         if not self.socket:
@@ -1,8 +1,40 @@
 import asyncio
-from p2p import P2PConnection, fetch_peer_secret, get_secret_data
+import hmac
+import json
+import os
+import time
+from api_client import (
+    announce_candidates,
+    answer_challenge,
+    list_candidates,
+    list_challenges,
+    list_reservations,
+    report_objects,
+)
+from merkle import MerkleBuilder
+from p2p import (
+    P2PConnection,
+    fetch_peer_secret,
+    get_secret_data,
+    load_or_create_keypair,
+    reservation_key,
+    reservation_proof,
+)
+from session import INITIAL_WINDOW, Session, SessionPool
+from storage import open_store
+from transfer import describe, download, iter_files, object_name, receive_files, send_files, serve_range
+from udp import candidate_addresses, close_shared_endpoints, connection_token, open_endpoint
+
+# Sessions to other peers, reused across operations within one process
+sessions = SessionPool()
+
+UDP_POLL_INTERVAL = 1.0  # seconds between host polls for new UDP requesters
+CHALLENGE_POLL_INTERVAL = 30.0  # seconds between host polls for proof-of-storage challenges
+RESERVATIONS_REFRESH_INTERVAL = 5.0  # minimum seconds between reservation list refreshes
+NONCE_SIZE = 16
 
 async def p2p_receive(reservation_id, local_port, storage_dir, server):
-    secret_data = get_secret_data(local_port)
+    secret_data = get_secret_data(local_port, reservation_id)
 
     # Fetch peer secret (blocking for now)
     peer_secret = await fetch_peer_secret(reservation_id, secret_data["peer_id"], server)
@@ -12,12 +44,291 @@ async def p2p_receive(reservation_id, local_port, storage_dir, server):
     # TODO: implement file-receiving logic here
     p2p.close()
 
-async def p2p_connect_and_send(reservation_id, client_id, local_port, file_path, server, report_usage_func):
-    secret = await fetch_peer_secret(reservation_id, client_id, server)
+async def peer_session(secret, local_port, reservation_id=None, client_id=None, server=None,
+                       udp=False, stun_server=None) -> Session:
+    """Return the pooled session to the peer described by `secret`.
+
+    With `udp`, a new session runs over a hole-punched reliable UDP
+    connection; our candidates are announced through the server first.
+    """
     p2p = P2PConnection(local_port)
-    await p2p.connect_to_peer(secret)
-    if file_path:
-        with file_path.open("rb") as f:
-            bytes_sent = p2p.send_data(f)
-            await report_usage_func(client_id, secret["peer_id"], bytes_sent, server)
-    p2p.close()
+    if not udp:
+        session = await sessions.get(secret["peer_id"], lambda: p2p.open_stream(secret))
+    else:
+        async def announce(candidates, connection_id):
+            await announce_candidates(reservation_id, client_id, candidates, connection_id, server)
+
+        session = await sessions.get(
+            secret["peer_id"],
+            lambda: p2p.open_udp(secret, reservation_id, stun_server, announce),
+        )
+    if reservation_id is not None:
+        await authenticate(session, reservation_id, secret["connection_key"])
+    return session
+
+async def authenticate(session, reservation_id, connection_key):
+    """Prove to the host that we hold `reservation_id` (once per session).
+
+    The host sends a nonce and we answer with an HMAC of it under the
+    reservation's connection key from the signed secret.
+    """
+    if reservation_id in session.authenticated:
+        return
+    stream = await session.open_stream({"op": "auth", "reservation_id": reservation_id})
+    nonce = await stream.readexactly(NONCE_SIZE)
+    stream.write(reservation_proof(connection_key, nonce))
+    await stream.write_eof()
+    await stream.read_all()
+    session.authenticated.add(reservation_id)
+
+async def close_sessions():
+    await sessions.close_all()
+    close_shared_endpoints()
+
+class HostedReservations:
+    """The reservations the server lists as approved for this host.
+
+    An unknown id triggers a refresh (at most every
+    RESERVATIONS_REFRESH_INTERVAL seconds), so reservations approved while
+    serving are picked up on first use.
+    """
+
+    def __init__(self, client_id, server, private_key):
+        self.client_id = client_id
+        self.server = server
+        self.private_key = private_key
+        self.amounts = {}
+        self._refreshed = None
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        listed = await list_reservations(self.client_id, self.server)
+        self.amounts = {r["reservation_id"]: r["amount"] for r in listed}
+        self._refreshed = time.monotonic()
+
+    async def approved(self, reservation_id) -> bool:
+        async with self._lock:
+            stale = self._refreshed is None or time.monotonic() - self._refreshed > RESERVATIONS_REFRESH_INTERVAL
+            if reservation_id not in self.amounts and stale:
+                await self.refresh()
+        return reservation_id in self.amounts
+
+    def key(self, reservation_id) -> str:
+        return reservation_key(self.private_key, reservation_id)
+
+def _reply(stream, **data):
+    stream.write(json.dumps(data).encode())
+
+def _reservation_id(stream):
+    """The header's reservation id, if the peer proved it holds it on this session."""
+    reservation_id = stream.header.get("reservation_id")
+    if reservation_id not in stream.session.authenticated:
+        raise PermissionError(f"Reservation {reservation_id} is not authenticated on this session")
+    return reservation_id
+
+async def _authenticate_peer(stream, reservations):
+    reservation_id = stream.header.get("reservation_id")
+    if not isinstance(reservation_id, str) or reservations is None or not await reservations.approved(reservation_id):
+        raise PermissionError(f"Unknown reservation: {reservation_id}")
+    nonce = os.urandom(NONCE_SIZE)
+    stream.write(nonce)
+    await stream.drain()
+    proof = await stream.read_all()
+    if not hmac.compare_digest(proof, reservation_proof(reservations.key(reservation_id), nonce)):
+        raise PermissionError(f"Wrong proof for reservation {reservation_id}")
+    stream.session.authenticated.add(reservation_id)
+    return reservation_id
+
+async def _handle_stream(store, stream, on_batch=None, reservations=None):
+    """Dispatch one incoming stream by the `op` in its header.
+
+    Objects are only reachable inside the namespace of a `reservation_id`
+    the peer authenticated on this session (see `authenticate`), and only
+    for reservations in `reservations`, each limited to its amount.
+    """
+    op = stream.header.get("op")
+    if op == "ping":
+        _reply(stream, ok=True)
+    elif op == "auth":
+        reservation_id = await _authenticate_peer(stream, reservations)
+        store.namespace_quotas[reservation_id] = reservations.amounts[reservation_id] * 1024 * 1024
+        _reply(stream, ok=True)
+    elif op == "put":
+        name = object_name(_reservation_id(stream), stream.header["name"])
+        size = stream.header["size"]
+        obj = store.writer(name, size)
+        try:
+            while True:
+                chunk = await stream.read(INITIAL_WINDOW)
+                if not chunk:
+                    break
+                obj.write(chunk)
+        except BaseException:
+            obj.abort()
+            raise
+        await asyncio.to_thread(obj.commit)
+        await asyncio.to_thread(store.sync)
+        _reply(stream, files=1, bytes=size)
+        if on_batch:
+            on_batch(1, size)
+    elif op == "stat":
+        name = object_name(_reservation_id(stream), stream.header["name"])
+        if name not in store:
+            raise FileNotFoundError(f"No such object: {stream.header['name']}")
+        _reply(stream, size=store.locate(name)[2])
+    elif op == "get":
+        await serve_range(stream, store, object_name(_reservation_id(stream), stream.header["name"]))
+    elif op == "upload":
+        count, total = await receive_files(stream, stream, store, _reservation_id(stream))
+        if on_batch:
+            on_batch(count, total)
+    else:
+        raise ValueError(f"Unknown operation: {op}")
+    await stream.drain()
+
+async def _accept_udp(local_port, handle, client_id, server):
+    """Punch towards requesters that announced UDP candidates for our reservations.
+
+    Each announcement is handed out once by the server and starts a new
+    connection under the id the requester picked for that session.
+    """
+    endpoint = await open_endpoint(local_port)
+
+    async def punch_and_serve(conn, addresses):
+        try:
+            await conn.punch(addresses)
+        except ConnectionError as e:
+            print(f"UDP hole punching failed: {e}")
+            return
+        await handle(conn, conn)
+
+    try:
+        while True:
+            try:
+                announced = await list_candidates(client_id, server)
+            except Exception as e:
+                print(f"Polling UDP candidates failed: {e}")
+                announced = []
+            for offer in announced:
+                try:
+                    key = (connection_token(offer["reservation_id"]), bytes.fromhex(offer["connection_id"]))
+                except ValueError:
+                    continue
+                if key in endpoint.connections:
+                    continue
+                conn = endpoint.connection(*key)
+                asyncio.create_task(punch_and_serve(conn, candidate_addresses(offer["candidates"])))
+            await asyncio.sleep(UDP_POLL_INTERVAL)
+    finally:
+        endpoint.close()
+
+async def p2p_serve(local_port, storage_dir, quota_mb=None, on_batch=None,
+                    udp=False, client_id=None, server_url=None):
+    """Accept peer sessions and serve their streams from the store in `storage_dir`.
+
+    Sessions arrive over TCP, and with `udp` also over hole-punched UDP
+    for requesters that announced candidates to `server_url`. Only
+    reservations the server lists as approved for `client_id` are served.
+    """
+    store = open_store(storage_dir, quota_mb)
+    store.start_compactor()
+
+    def scrubbed(corrupt):
+        if corrupt:
+            print(f"Scrub found {len(corrupt)} corrupt objects: {', '.join(sorted(corrupt))}")
+
+    store.start_scrubber(on_scrubbed=scrubbed)
+    reservations = HostedReservations(client_id, server_url, load_or_create_keypair()[0]) if client_id else None
+    challenge_task = asyncio.create_task(_poll_challenges(store, client_id, server_url)) if client_id else None
+
+    async def handle(reader, writer):
+        session = Session(
+            reader, writer,
+            handler=lambda stream: _handle_stream(store, stream, on_batch, reservations),
+            initiator=False,
+        )
+        await session.wait_closed()
+
+    server = await asyncio.start_server(handle, port=local_port)
+    udp_task = asyncio.create_task(_accept_udp(local_port, handle, client_id, server_url)) if udp else None
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in (udp_task, challenge_task):
+            if task:
+                task.cancel()
+        store.close()
+
+async def p2p_connect_and_send(reservation_id, client_id, local_port, file_paths, server, report_usage_func,
+                               udp=False, stun_server=None):
+    secret = await fetch_peer_secret(reservation_id, client_id, server)
+    session = await peer_session(secret, local_port, reservation_id, client_id, server, udp, stun_server)
+    files = list(iter_files(file_paths or []))
+    if not files:
+        await session.request({"op": "ping"})
+        return 0, 0
+    objects = []
+    if len(files) == 1 and files[0][1].stat().st_size <= INITIAL_WINDOW:
+        # A single small file is one request frame and one reply
+        name, path = files[0]
+        data = path.read_bytes()
+        header = {"op": "put", "reservation_id": reservation_id, "name": name, "size": len(data)}
+        reply = json.loads(await session.request(header, data))
+        count, bytes_sent = reply["files"], reply["bytes"]
+        tree = MerkleBuilder()
+        tree.update(data)
+        objects.append(describe(name, tree, len(data)))
+    else:
+        stream = await session.open_stream({"op": "upload", "reservation_id": reservation_id})
+        try:
+            count, bytes_sent = await send_files(stream, stream, files, objects=objects)
+        except BaseException as e:
+            # The host would otherwise keep waiting for the rest of the batch
+            stream.reset(str(e) or type(e).__name__)
+            raise
+        await stream.write_eof()
+    # Merkle roots let the server challenge the host later without a download
+    await report_objects(reservation_id, client_id, objects, server)
+    await report_usage_func(client_id, secret["peer_id"], bytes_sent, server)
+    return count, bytes_sent
+
+async def p2p_retrieve(reservation_id, client_id, local_port, name, output_path, server,
+                       offset=0, length=None, parallel=4, udp=False, stun_server=None):
+    """Download a stored object, or a byte range of it, back from the host."""
+    secret = await fetch_peer_secret(reservation_id, client_id, server)
+    session = await peer_session(secret, local_port, reservation_id, client_id, server, udp, stun_server)
+    return await download(session, reservation_id, name, output_path, offset, length, parallel)
+
+def answer_pending_challenges(store, client_id, server):
+    """Answer the server's pending proof-of-storage challenges from `store`."""
+    answered = []
+    for challenge in list_challenges(client_id, server):
+        try:
+            name = object_name(challenge["reservation_id"], challenge["name"])
+            leaf, proof = store.prove(name, challenge["leaf"])
+        except (KeyError, IndexError, PermissionError, OSError):
+            leaf, proof = b"", []
+        answered.append(answer_challenge(challenge["challenge_id"], leaf, proof, server))
+    return answered
+
+def answer_challenges(client_id, storage_dir, server):
+    """Answer pending challenges from the store in `storage_dir`.
+
+    Raises RuntimeError while a `p2p_serve` holds that store.
+    """
+    store = open_store(storage_dir)
+    try:
+        return answer_pending_challenges(store, client_id, server)
+    finally:
+        store.close()
+
+async def _poll_challenges(store, client_id, server):
+    """Answer challenges from the served store before they expire."""
+    while True:
+        try:
+            for result in await asyncio.to_thread(answer_pending_challenges, store, client_id, server):
+                print(f"Challenge {result['challenge_id']}: {result['status']}")
+        except Exception as e:
+            print(f"Answering challenges failed: {e}")
+        await asyncio.sleep(CHALLENGE_POLL_INTERVAL)
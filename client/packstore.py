@@ -0,0 +1,682 @@
+import fcntl
+import hashlib
+import io
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import merkle
+
+# Index: a fixed-size open-addressing hash table kept in a memory-mapped file.
+# header: magic, slot count, occupied slots (live + tombstones)
+INDEX_HEADER = struct.Struct("<8sQQ")
+# slot: sha256(name), state, pack id, data offset, data length, name length
+INDEX_SLOT = struct.Struct("<32sBIQQH")
+INDEX_MAGIC = b"PSIDX1\0\0"
+INDEX_MIN_SLOTS = 1024
+INDEX_MAX_LOAD = 0.7
+
+EMPTY, PACKED, LARGE, DELETED = 0, 1, 2, 3
+
+# Pack record: magic, name length, data length, followed by name and data
+RECORD_HEADER = struct.Struct("<4sHI")
+RECORD_MAGIC = b"PKR1"
+
+SMALL_OBJECT_LIMIT = 64 * 1024
+PACK_SIZE_LIMIT = 64 * 1024 * 1024
+COMPACT_DEAD_RATIO = 0.5
+SCRUB_RATE = 4 * 1024 * 1024  # bytes/second read by the background scrubber
+
+# Merkle leaf hashes of every object are kept as a sidecar object under this prefix
+MERKLE_PREFIX = "\0merkle/"
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _digest(name: str) -> bytes:
+    return hashlib.sha256(name.encode()).digest()
+
+
+def _namespace(name: str) -> Optional[str]:
+    """The part of `name` before its first "/" (sidecars have none)."""
+    if name.startswith(MERKLE_PREFIX) or "/" not in name:
+        return None
+    return name.split("/", 1)[0]
+
+
+class PackStore:
+    """Object store that appends small objects into packfiles.
+
+    Objects up to `small_limit` bytes are appended to the active packfile and
+    located through a memory-mapped hash index, so lookups cost one probe and
+    one pread. Larger objects are stored as plain files under `objects/`.
+
+    Besides the overall `quota`, `namespace_quotas` can limit the bytes
+    stored under each "<namespace>/" name prefix.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        quota: Optional[int] = None,
+        small_limit: int = SMALL_OBJECT_LIMIT,
+        pack_limit: int = PACK_SIZE_LIMIT,
+    ):
+        self.root = Path(root)
+        self.quota = quota
+        self.small_limit = small_limit
+        self.pack_limit = pack_limit
+        self.packs_dir = self.root / "packs"
+        self.objects_dir = self.root / "objects"
+        self.packs_dir.mkdir(parents=True, exist_ok=True)
+        (self.objects_dir / "tmp").mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._pack_fds: Dict[int, int] = {}
+        self._live_bytes: Dict[int, int] = {}
+        self._pending = 0
+        self.used = 0
+        self.namespace_quotas: Dict[str, int] = {}
+        self._namespace_used: Dict[str, int] = {}
+        self._namespace_pending: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._compactor: Optional[threading.Thread] = None
+        self._scrubber: Optional[threading.Thread] = None
+        self.corrupt: Set[str] = set()
+
+        self._lock_fd = self._lock_root()
+        self._open_index()
+        existing = sorted(self._pack_ids())
+        self._active = existing[-1] if existing else 1
+        self._drop_torn_tail(self._active)
+        self._load_stats()
+        self._open_pack(self._active)
+        self._load_namespaces()
+
+    def _lock_root(self) -> int:
+        # Opening repairs the active pack, so only one PackStore may use a root
+        fd = os.open(self.root / "lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RuntimeError(f"Store {self.root} is already open")
+        return fd
+
+    # --- index ---
+    def _open_index(self, slots: int = INDEX_MIN_SLOTS):
+        path = self.root / "index.idx"
+        if not path.exists():
+            self._write_empty_index(path, slots)
+        self._index_fd = os.open(path, os.O_RDWR)
+        self._index = mmap.mmap(self._index_fd, os.fstat(self._index_fd).st_size)
+        magic, self._slots, self._occupied = INDEX_HEADER.unpack_from(self._index, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"Corrupt index file: {path}")
+
+    @staticmethod
+    def _write_empty_index(path: Path, slots: int):
+        with open(path, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, slots, 0))
+            f.truncate(INDEX_HEADER.size + slots * INDEX_SLOT.size)
+
+    def _slot_offset(self, i: int) -> int:
+        return INDEX_HEADER.size + i * INDEX_SLOT.size
+
+    def _read_slot(self, i: int) -> Tuple:
+        return INDEX_SLOT.unpack_from(self._index, self._slot_offset(i))
+
+    def _write_slot(self, i: int, *entry):
+        INDEX_SLOT.pack_into(self._index, self._slot_offset(i), *entry)
+
+    def _find(self, digest: bytes) -> Tuple[int, Optional[Tuple]]:
+        """Return (slot, entry) for `digest`, or (insert slot, None)."""
+        i = int.from_bytes(digest[:8], "little") % self._slots
+        free = None
+        while True:
+            entry = self._read_slot(i)
+            state = entry[1]
+            if state == EMPTY:
+                return (free if free is not None else i), None
+            if state == DELETED:
+                if free is None:
+                    free = i
+            elif entry[0] == digest:
+                return i, entry
+            i = (i + 1) % self._slots
+
+    def _set_occupied(self, n: int):
+        self._occupied = n
+        INDEX_HEADER.pack_into(self._index, 0, INDEX_MAGIC, self._slots, n)
+
+    def _insert(self, name: str, state: int, pack: int, offset: int, length: int):
+        if (self._occupied + 1) / self._slots > INDEX_MAX_LOAD:
+            self._grow_index()
+        digest, name_len = _digest(name), len(name.encode())
+        i, entry = self._find(digest)
+        if entry is not None:
+            self._release(name, entry)
+        elif self._read_slot(i)[1] == EMPTY:
+            self._set_occupied(self._occupied + 1)
+        self._write_slot(i, digest, state, pack, offset, length, name_len)
+        self.used += length
+        self._count(self._namespace_used, name, length)
+        if state == PACKED:
+            self._live_bytes[pack] = self._live_bytes.get(pack, 0) + RECORD_HEADER.size + name_len + length
+
+    def _release(self, name: str, entry: Tuple):
+        digest, state, pack, offset, length, name_len = entry
+        self.used -= length
+        self._count(self._namespace_used, name, -length)
+        if state == PACKED:
+            self._live_bytes[pack] -= RECORD_HEADER.size + name_len + length
+        elif state == LARGE:
+            path = self._large_path(digest)
+            path.unlink(missing_ok=True)
+            path.with_name(path.name + ".name").unlink(missing_ok=True)
+
+    def _grow_index(self):
+        live = [e for e in self._entries() if e[1] in (PACKED, LARGE)]
+        slots = max(INDEX_MIN_SLOTS, int(len(live) / INDEX_MAX_LOAD) * 2)
+        path = self.root / "index.idx"
+        tmp = self.root / "index.idx.tmp"
+        self._write_empty_index(tmp, slots)
+        self._close_index()
+        os.replace(tmp, path)
+        self._open_index()
+        for entry in live:
+            i, _ = self._find(entry[0])
+            self._write_slot(i, *entry)
+        self._set_occupied(len(live))
+
+    def _close_index(self):
+        self._index.flush()
+        self._index.close()
+        os.close(self._index_fd)
+
+    def _entries(self) -> Iterator[Tuple]:
+        for i in range(self._slots):
+            entry = self._read_slot(i)
+            if entry[1] != EMPTY:
+                yield entry
+
+    @staticmethod
+    def _count(counts: Dict[str, int], name: str, delta: int):
+        namespace = _namespace(name)
+        if namespace is not None:
+            counts[namespace] = counts.get(namespace, 0) + delta
+
+    def _load_namespaces(self):
+        # The index holds no names, so per-namespace usage is rebuilt from the packs
+        for pack in sorted(self._pack_ids()):
+            try:
+                for name, offset, length in self._scan_pack(pack):
+                    _, entry = self._find(_digest(name))
+                    if entry and entry[1] == PACKED and entry[2] == pack and entry[3] == offset:
+                        self._count(self._namespace_used, name, length)
+            except ValueError as e:
+                print(f"Namespace usage of {self.root} is incomplete: {e}")
+        for path in self.objects_dir.glob("??/*.name"):
+            name = path.read_text()
+            _, entry = self._find(_digest(name))
+            if entry and entry[1] == LARGE:
+                self._count(self._namespace_used, name, entry[4])
+
+    def _load_stats(self):
+        for _, state, pack, _, length, name_len in self._entries():
+            if state in (PACKED, LARGE):
+                self.used += length
+            if state == PACKED:
+                self._live_bytes[pack] = self._live_bytes.get(pack, 0) + RECORD_HEADER.size + name_len + length
+
+    # --- packs ---
+    def _pack_path(self, pack: int) -> Path:
+        return self.packs_dir / f"pack-{pack:06d}.dat"
+
+    def _pack_ids(self) -> List[int]:
+        return [int(p.stem.split("-")[1]) for p in self.packs_dir.glob("pack-*.dat")]
+
+    def _open_pack(self, pack: int) -> int:
+        fd = self._pack_fds.get(pack)
+        if fd is None:
+            # Only the active pack may be created; a missing sealed pack is an error
+            flags = os.O_RDWR | os.O_APPEND | (os.O_CREAT if pack == self._active else 0)
+            fd = os.open(self._pack_path(pack), flags, 0o644)
+            self._pack_fds[pack] = fd
+        return fd
+
+    def _drop_torn_tail(self, pack: int):
+        """Truncate `pack` after its last complete record.
+
+        A crash during an append can leave a partial record at the end of
+        the active pack; records appended behind it could never be scanned.
+        Index entries pointing past the cut are dropped with it.
+        """
+        path = self._pack_path(pack)
+        if not path.exists():
+            return
+        size = path.stat().st_size
+        end = 0
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                magic, name_len, length = RECORD_HEADER.unpack(header)
+                record_end = end + RECORD_HEADER.size + name_len + length
+                if magic != RECORD_MAGIC or record_end > size:
+                    break
+                end = record_end
+                f.seek(end)
+        if end == size:
+            return
+        print(f"Dropping {size - end} bytes of incomplete records at the end of {path}")
+        os.truncate(path, end)
+        for i in range(self._slots):
+            digest, state, entry_pack, offset, length, _ = self._read_slot(i)
+            if state == PACKED and entry_pack == pack and offset + length > end:
+                self._write_slot(i, digest, DELETED, 0, 0, 0, 0)
+        self._index.flush()
+
+    def _append(self, name: bytes, data: bytes) -> Tuple[int, int]:
+        fd = self._open_pack(self._active)
+        start = os.fstat(fd).st_size
+        if start and start + len(data) > self.pack_limit:
+            os.fsync(fd)
+            self._active += 1
+            fd = self._open_pack(self._active)
+            start = 0
+        os.write(fd, RECORD_HEADER.pack(RECORD_MAGIC, len(name), len(data)) + name + data)
+        return self._active, start + RECORD_HEADER.size + len(name)
+
+    def _large_path(self, digest: bytes) -> Path:
+        h = digest.hex()
+        return self.objects_dir / h[:2] / h
+
+    # --- public API ---
+    def _reserve(self, name: str, size: int):
+        _, entry = self._find(_digest(name))
+        replaced = entry[4] if entry else 0
+        if self.quota is not None and self.used + self._pending + size - replaced > self.quota:
+            raise QuotaExceeded(
+                f"Storing {size} bytes would exceed quota of {self.quota} bytes "
+                f"({self.used} used)"
+            )
+        namespace = _namespace(name)
+        limit = self.namespace_quotas.get(namespace)
+        if limit is not None:
+            used = self._namespace_used.get(namespace, 0)
+            if used + self._namespace_pending.get(namespace, 0) + size - replaced > limit:
+                raise QuotaExceeded(
+                    f"Storing {size} bytes would exceed quota of {limit} bytes "
+                    f"for {namespace} ({used} used)"
+                )
+        self._add_pending(name, size)
+
+    def _add_pending(self, name: str, delta: int):
+        self._pending += delta
+        self._count(self._namespace_pending, name, delta)
+
+    def put(self, name: str, data: bytes):
+        """Store `data` under `name`, replacing any previous object."""
+        with self.writer(name, len(data)) as w:
+            w.write(data)
+
+    def writer(self, name: str, size: int) -> "ObjectWriter":
+        """Return a writer for an object of exactly `size` bytes."""
+        with self._lock:
+            self._reserve(name, size)
+        return ObjectWriter(self, name, size)
+
+    def _commit_small(self, name: str, data: bytes):
+        key = name.encode()
+        with self._lock:
+            self._add_pending(name, -len(data))
+            pack, offset = self._append(key, data)
+            self._insert(name, PACKED, pack, offset, len(data))
+
+    def _commit_large(self, name: str, tmp_path: Path, size: int):
+        digest = _digest(name)
+        path = self._large_path(digest)
+        path.parent.mkdir(exist_ok=True)
+        with self._lock:
+            self._add_pending(name, -size)
+            i, entry = self._find(digest)
+            if entry is not None:
+                self._release(name, entry)
+                self._write_slot(i, digest, DELETED, 0, 0, 0, 0)
+            os.replace(tmp_path, path)
+            self._insert(name, LARGE, 0, 0, size)
+
+    def _abort(self, name: str, size: int):
+        with self._lock:
+            self._add_pending(name, -size)
+
+    def locate(self, name: str) -> Tuple[Path, int, int]:
+        """Return (file path, offset, length) holding the object's bytes."""
+        digest = _digest(name)
+        with self._lock:
+            _, entry = self._find(digest)
+            if entry is None:
+                raise KeyError(name)
+            _, state, pack, offset, length, _ = entry
+            if state == LARGE:
+                return self._large_path(digest), 0, length
+            return self._pack_path(pack), offset, length
+
+    def open_object(self, name: str) -> Tuple[BinaryIO, int, int]:
+        """Open the file holding an object; returns (file, offset, length).
+
+        The file is opened under the store lock, so a concurrent compaction
+        cannot remove the pack in between.
+        """
+        with self._lock:
+            path, offset, length = self.locate(name)
+            return open(path, "rb"), offset, length
+
+    def get(self, name: str) -> bytes:
+        with self._lock:
+            path, offset, length = self.locate(name)
+            if path.parent == self.packs_dir:
+                return os.pread(self._open_pack(int(path.stem.split("-")[1])), length, offset)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def delete(self, name: str):
+        with self._lock:
+            i, entry = self._find(_digest(name))
+            if entry is None:
+                raise KeyError(name)
+            self._release(name, entry)
+            self._write_slot(i, entry[0], DELETED, 0, 0, 0, 0)
+            if not name.startswith(MERKLE_PREFIX) and MERKLE_PREFIX + name in self:
+                self.delete(MERKLE_PREFIX + name)
+            self.corrupt.discard(name)
+
+    # --- integrity ---
+    def _put_leaves(self, name: str, leaves: List[bytes]):
+        # Single-leaf objects are their own tree. Larger sidecars (32 bytes per
+        # leaf) count as used space but are not refused by the quota check.
+        if len(leaves) == 1:
+            if MERKLE_PREFIX + name in self:
+                self.delete(MERKLE_PREFIX + name)
+            return
+        data = b"".join(leaves)
+        with self._lock:
+            self._add_pending(MERKLE_PREFIX + name, len(data))
+        with ObjectWriter(self, MERKLE_PREFIX + name, len(data), hashed=False) as w:
+            w.write(data)
+
+    def merkle_leaves(self, name: str) -> List[bytes]:
+        try:
+            data = self.get(MERKLE_PREFIX + name)
+        except KeyError:
+            if self.locate(name)[2] > merkle.LEAF_SIZE:
+                raise
+            return [merkle.leaf_hash(self.get(name))]
+        return [data[i:i + merkle.HASH_SIZE] for i in range(0, len(data), merkle.HASH_SIZE)]
+
+    def merkle_root(self, name: str) -> bytes:
+        return merkle.root(self.merkle_leaves(name))
+
+    def prove(self, name: str, index: int) -> Tuple[bytes, List[bytes]]:
+        """Return leaf `index` of an object and its Merkle proof."""
+        leaves = self.merkle_leaves(name)
+        if not 0 <= index < len(leaves):
+            raise IndexError(f"{name} has {len(leaves)} leaves, not {index + 1}")
+        f, offset, length = self.open_object(name)
+        with f:
+            start = index * merkle.LEAF_SIZE
+            leaf = os.pread(f.fileno(), min(merkle.LEAF_SIZE, length - start), offset + start)
+        return leaf, merkle.prove(leaves, index)
+
+    def verify(self, name: str, rate: Optional[float] = None) -> Optional[List[int]]:
+        """Re-hash an object against its stored leaves; return the bad leaf indexes.
+
+        With `rate` (bytes/second) reads are spread out to limit I/O load.
+        Returns None if closing the store interrupts the check.
+        """
+        leaves = self.merkle_leaves(name)
+        f, offset, length = self.open_object(name)
+        bad = []
+        started = time.monotonic()
+        with f:
+            for index, pos in enumerate(range(0, max(length, 1), merkle.LEAF_SIZE)):
+                leaf = os.pread(f.fileno(), min(merkle.LEAF_SIZE, length - pos), offset + pos)
+                if index >= len(leaves) or merkle.leaf_hash(leaf) != leaves[index]:
+                    bad.append(index)
+                if rate:
+                    ahead = (pos + len(leaf)) / rate - (time.monotonic() - started)
+                    if ahead > 0 and self._stop.wait(ahead):
+                        return None
+        if len(leaves) > index + 1:
+            bad.extend(range(index + 1, len(leaves)))
+        return bad
+
+    def scrub(self, rate: Optional[float] = SCRUB_RATE) -> Set[str]:
+        """Verify every object once; returns (and records) the corrupt ones."""
+        for name in list(self.names()):
+            if self._stop.is_set():
+                break
+            try:
+                bad = self.verify(name, rate)
+            except KeyError:
+                continue  # deleted while scrubbing
+            if bad is None:
+                continue  # interrupted, no verdict
+            if bad:
+                self.corrupt.add(name)
+            else:
+                self.corrupt.discard(name)
+        return self.corrupt
+
+    def start_scrubber(self, rate: float = SCRUB_RATE, interval: float = 3600.0,
+                       on_scrubbed: Optional[Callable[[Set[str]], None]] = None):
+        """Run a throttled `scrub` every `interval` seconds on a daemon thread.
+
+        `on_scrubbed` gets the corrupt object names after every complete
+        pass. A failing pass is logged and retried at the next interval.
+        """
+        def _loop():
+            while not self._stop.is_set():
+                try:
+                    corrupt = self.scrub(rate)
+                    if on_scrubbed and not self._stop.is_set():
+                        on_scrubbed(set(corrupt))
+                except Exception as e:
+                    print(f"Scrubbing {self.root} failed: {e!r}")
+                self._stop.wait(interval)
+
+        self._scrubber = threading.Thread(target=_loop, name="packstore-scrubber", daemon=True)
+        self._scrubber.start()
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return self._find(_digest(name))[1] is not None
+
+    def names(self) -> Iterator[str]:
+        """Yield the names of all stored objects (scans the packfiles)."""
+        for pack in sorted(self._pack_ids()):
+            try:
+                for name, offset, _ in self._scan_pack(pack):
+                    with self._lock:
+                        _, entry = self._find(_digest(name))
+                    if entry and entry[1] == PACKED and entry[2] == pack and entry[3] == offset:
+                        if not name.startswith(MERKLE_PREFIX):
+                            yield name
+            except FileNotFoundError:
+                continue  # compacted meanwhile; its live objects moved to the active pack
+        for path in self.objects_dir.glob("??/*.name"):
+            name = path.read_text()
+            if not name.startswith(MERKLE_PREFIX):
+                yield name
+
+    def _scan_pack(self, pack: int) -> Iterator[Tuple[str, int, int]]:
+        """Yield (name, data offset, length) for every record in a pack."""
+        with open(self._pack_path(pack), "rb") as f:
+            pos = 0
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                magic, name_len, length = RECORD_HEADER.unpack(header)
+                if magic != RECORD_MAGIC:
+                    raise ValueError(f"Corrupt record in {self._pack_path(pack)} at {pos}")
+                name = f.read(name_len).decode()
+                data_offset = pos + RECORD_HEADER.size + name_len
+                f.seek(length, io.SEEK_CUR)
+                pos = data_offset + length
+                yield name, data_offset, length
+
+    # --- compaction ---
+    def compact(self, dead_ratio: float = COMPACT_DEAD_RATIO) -> int:
+        """Rewrite sealed packs whose dead fraction exceeds `dead_ratio`.
+
+        Returns the number of bytes reclaimed.
+        """
+        reclaimed = 0
+        for pack in sorted(self._pack_ids()):
+            if pack == self._active:
+                continue
+            size = self._pack_path(pack).stat().st_size
+            if size and 1 - self._live_bytes.get(pack, 0) / size < dead_ratio:
+                continue
+            for name, offset, length in self._scan_pack(pack):
+                with self._lock:
+                    digest = _digest(name)
+                    i, entry = self._find(digest)
+                    if not entry or entry[1] != PACKED or entry[2] != pack or entry[3] != offset:
+                        continue
+                    data = os.pread(self._open_pack(pack), length, offset)
+                    new_pack, new_offset = self._append(name.encode(), data)
+                    self._write_slot(i, digest, PACKED, new_pack, new_offset, length, entry[5])
+                    moved = RECORD_HEADER.size + entry[5] + length
+                    self._live_bytes[pack] -= moved
+                    self._live_bytes[new_pack] = self._live_bytes.get(new_pack, 0) + moved
+            with self._lock:
+                if self._live_bytes.get(pack, 0) > 0:
+                    # The scan missed live records; unlinking would lose them
+                    print(f"Not compacting {self._pack_path(pack)}: "
+                          f"{self._live_bytes[pack]} live bytes were not found by the scan")
+                    continue
+                # The moved records and their new index slots must be durable
+                # before the only other copy goes away
+                os.fsync(self._open_pack(self._active))
+                self._index.flush()
+                fd = self._pack_fds.pop(pack, None)
+                if fd is not None:
+                    os.close(fd)
+                self._pack_path(pack).unlink()
+                self._live_bytes.pop(pack, None)
+            reclaimed += size
+        return reclaimed
+
+    def start_compactor(self, interval: float = 60.0):
+        """Run `compact` periodically on a daemon thread.
+
+        A failing run is logged and retried at the next interval.
+        """
+        def _loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"Compacting {self.root} failed: {e!r}")
+
+        self._compactor = threading.Thread(target=_loop, name="packstore-compactor", daemon=True)
+        self._compactor.start()
+
+    def sync(self):
+        with self._lock:
+            os.fsync(self._open_pack(self._active))
+            self._index.flush()
+
+    def close(self):
+        self._stop.set()
+        for thread in (self._compactor, self._scrubber):
+            if thread:
+                thread.join()
+        with self._lock:
+            self.sync()
+            for fd in self._pack_fds.values():
+                os.close(fd)
+            self._pack_fds.clear()
+            self._close_index()
+            os.close(self._lock_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ObjectWriter:
+    """Incremental writer returned by `PackStore.writer`."""
+
+    def __init__(self, store: PackStore, name: str, size: int, hashed: bool = True):
+        self.store = store
+        self.name = name
+        self.size = size
+        self.written = 0
+        self._merkle = merkle.MerkleBuilder() if hashed else None
+        if size <= store.small_limit:
+            self._buf = bytearray()
+            self._file = None
+        else:
+            self._buf = None
+            self._tmp = store.objects_dir / "tmp" / uuid.uuid4().hex
+            self._file = open(self._tmp, "wb")
+
+    def write(self, data: bytes) -> int:
+        if self.written + len(data) > self.size:
+            raise ValueError(f"Object {self.name} is larger than declared {self.size} bytes")
+        if self._file:
+            self._file.write(data)
+        else:
+            self._buf += data
+        if self._merkle:
+            self._merkle.update(data)
+        self.written += len(data)
+        return len(data)
+
+    def commit(self):
+        if self.written != self.size:
+            self.abort()
+            raise ValueError(f"Object {self.name}: got {self.written} of {self.size} bytes")
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self.store._commit_large(self.name, self._tmp, self.size)
+            self._large_name_file().write_text(self.name)
+        else:
+            self.store._commit_small(self.name, bytes(self._buf))
+        if self._merkle:
+            self.store._put_leaves(self.name, self._merkle.finish())
+
+    def _large_name_file(self) -> Path:
+        path = self.store._large_path(_digest(self.name))
+        return path.with_name(path.name + ".name")
+
+    def abort(self):
+        if self._file:
+            self._file.close()
+            self._tmp.unlink(missing_ok=True)
+        self.store._abort(self.name, self.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
@@ -0,0 +1,327 @@
+import asyncio
+import json
+import os
+import struct
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+# Frame: stream id, frame type, flags, payload length
+FRAME = struct.Struct("!IBBI")
+OPEN, DATA, WINDOW, RESET = 0, 1, 2, 3
+FLAG_FIN = 1
+# OPEN payload starts with the length of its JSON header, followed by body bytes
+OPEN_HEADER = struct.Struct("!H")
+WINDOW_UPDATE = struct.Struct("!I")
+
+INITIAL_WINDOW = 256 * 1024
+MAX_FRAME = 64 * 1024
+
+
+class Stream:
+    """One logical, flow-controlled stream inside a `Session`.
+
+    Offers the subset of the asyncio StreamReader/StreamWriter interface the
+    transfer code uses (read, readexactly, write, drain), so it can be passed
+    as both reader and writer.
+    """
+
+    def __init__(self, session: "Session", stream_id: int, header: Optional[dict] = None):
+        self.session = session
+        self.id = stream_id
+        self.header = header or {}
+        self._buf = bytearray()
+        self._eof = False
+        self._error: Optional[str] = None
+        self._data_ready = asyncio.Event()
+        self._send_window = INITIAL_WINDOW
+        self._window_open = asyncio.Event()
+        self._consumed = 0
+        self._pending = bytearray()
+        self._fin_sent = False
+
+    # --- called by the session ---
+    def _feed(self, data: bytes):
+        self._buf += data
+        self._data_ready.set()
+
+    def _feed_eof(self):
+        self._eof = True
+        self._data_ready.set()
+        self._maybe_done()
+
+    def _maybe_done(self):
+        # Both directions finished: the session no longer routes frames here
+        if self._eof and self._fin_sent:
+            self.session._streams.pop(self.id, None)
+
+    def _reset(self, error: str):
+        self._error = error
+        self._data_ready.set()
+        self._window_open.set()
+
+    def _grant(self, n: int):
+        self._send_window += n
+        self._window_open.set()
+
+    # --- reading ---
+    async def read(self, n: int = -1) -> bytes:
+        """Read up to `n` bytes (all remaining bytes if `n` < 0); b"" at EOF."""
+        if n < 0:
+            return await self.read_all()
+        while not self._buf and not self._eof and not self._error:
+            self._data_ready.clear()
+            await self._data_ready.wait()
+        if self._error and not self._buf:
+            raise ConnectionError(f"Stream reset by peer: {self._error}")
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        self._ack(len(data))
+        return data
+
+    async def readexactly(self, n: int) -> bytes:
+        data = bytearray()
+        while len(data) < n:
+            chunk = await self.read(n - len(data))
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(data), n)
+            data += chunk
+        return bytes(data)
+
+    async def read_all(self) -> bytes:
+        data = bytearray()
+        while True:
+            chunk = await self.read(MAX_FRAME)
+            if not chunk:
+                return bytes(data)
+            data += chunk
+
+    def _ack(self, n: int):
+        # Hand credit back once half the window has been consumed
+        self._consumed += n
+        if self._consumed >= INITIAL_WINDOW // 2 and not self.session.closed:
+            self.session._send_frame(self.id, WINDOW, 0, WINDOW_UPDATE.pack(self._consumed))
+            self._consumed = 0
+
+    # --- writing ---
+    def write(self, data: bytes):
+        self._pending += data
+
+    async def drain(self):
+        """Send buffered data, waiting for window credit from the peer."""
+        while self._pending:
+            while self._send_window <= 0 and not self._error:
+                self._window_open.clear()
+                await self._window_open.wait()
+            if self._error:
+                raise ConnectionError(f"Stream reset by peer: {self._error}")
+            n = min(len(self._pending), self._send_window, MAX_FRAME)
+            self.session._send_frame(self.id, DATA, 0, bytes(self._pending[:n]))
+            del self._pending[:n]
+            self._send_window -= n
+            await self.session._drain()
+
+    async def sendfile(self, file, offset: int, count: int):
+        """Send `count` bytes of `file` from `offset` without copying them
+        through user space (os.sendfile where the transport supports it)."""
+        await self.drain()
+        while count:
+            while self._send_window <= 0 and not self._error:
+                self._window_open.clear()
+                await self._window_open.wait()
+            if self._error:
+                raise ConnectionError(f"Stream reset by peer: {self._error}")
+            n = min(count, self._send_window)
+            await self.session._sendfile_frame(self.id, file, offset, n)
+            self._send_window -= n
+            offset += n
+            count -= n
+
+    async def write_eof(self):
+        await self.drain()
+        if not self._fin_sent:
+            self._fin_sent = True
+            self.session._send_frame(self.id, DATA, FLAG_FIN)
+            self._maybe_done()
+            await self.session._drain()
+
+    def close(self):
+        """Half-close the stream once buffered data has been sent."""
+        if not self._fin_sent and not self.session.closed:
+            self.session._spawn(self.write_eof())
+
+    def reset(self, error: str):
+        """Abort the stream in both directions; the peer sees `error`."""
+        if not self.session.closed:
+            self.session._send_frame(self.id, RESET, 0, error.encode())
+        self._reset(error)
+        self.session._streams.pop(self.id, None)
+
+
+StreamHandler = Callable[[Stream], Awaitable[None]]
+
+
+class Session:
+    """Long-lived connection carrying many independent `Stream`s.
+
+    The side that connects (`initiator`) uses odd stream ids, the accepting
+    side even ones. Incoming streams are passed to `handler`; if it raises,
+    the stream is reset with the error message.
+    """
+
+    def __init__(self, reader, writer, handler: Optional[StreamHandler] = None, initiator: bool = True):
+        self.reader = reader
+        self.writer = writer
+        self.handler = handler
+        self._next_id = 1 if initiator else 2
+        self._streams: Dict[int, Stream] = {}
+        self._tasks = set()
+        self._drain_lock = asyncio.Lock()
+        # Frames queued by other streams while a sendfile owns the socket
+        self._held: Optional[list] = None
+        self.closed = False
+        # Reservation ids proven on this session (see p2p_ops.authenticate)
+        self.authenticated: Set[str] = set()
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _send_frame(self, stream_id: int, kind: int, flags: int, payload: bytes = b""):
+        if self.closed:
+            raise ConnectionError("Session closed")
+        frame = FRAME.pack(stream_id, kind, flags, len(payload)) + payload
+        if self._held is not None:
+            self._held.append(frame)
+        else:
+            self.writer.write(frame)
+
+    async def _drain(self):
+        async with self._drain_lock:
+            await self.writer.drain()
+
+    async def _sendfile_frame(self, stream_id: int, file, offset: int, count: int):
+        if not isinstance(self.writer, asyncio.StreamWriter):
+            # Transports without a kernel socket (e.g. reliable UDP) get a copy
+            self._send_frame(stream_id, DATA, 0, os.pread(file.fileno(), count, offset))
+            await self._drain()
+            return
+        async with self._drain_lock:
+            self.writer.write(FRAME.pack(stream_id, DATA, 0, count))
+            await self.writer.drain()
+            self._held = []
+            try:
+                await asyncio.get_running_loop().sendfile(self.writer.transport, file, offset, count)
+            finally:
+                held, self._held = self._held, None
+                for frame in held:
+                    self.writer.write(frame)
+
+    async def open_stream(self, header: dict, body: bytes = b"", fin: bool = False) -> Stream:
+        """Open a stream; a small `body` rides along in the OPEN frame."""
+        stream = Stream(self, self._next_id, header)
+        self._next_id += 2
+        self._streams[stream.id] = stream
+        inline = body[:min(INITIAL_WINDOW, MAX_FRAME)]
+        stream.write(body[len(inline):])
+        stream._send_window -= len(inline)
+        encoded = json.dumps(header).encode()
+        fin_now = fin and len(inline) == len(body)
+        self._send_frame(
+            stream.id, OPEN, FLAG_FIN if fin_now else 0,
+            OPEN_HEADER.pack(len(encoded)) + encoded + inline,
+        )
+        stream._fin_sent = fin_now
+        if fin:
+            await stream.write_eof()
+        else:
+            await stream.drain()
+        await self._drain()
+        return stream
+
+    async def request(self, header: dict, body: bytes = b"") -> bytes:
+        """Send a one-shot request and return the peer's complete reply."""
+        stream = await self.open_stream(header, body, fin=True)
+        return await stream.read_all()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                stream_id, kind, flags, length = FRAME.unpack(await self.reader.readexactly(FRAME.size))
+                payload = await self.reader.readexactly(length) if length else b""
+                if kind == OPEN:
+                    (hlen,) = OPEN_HEADER.unpack_from(payload)
+                    header = json.loads(payload[OPEN_HEADER.size:OPEN_HEADER.size + hlen])
+                    stream = Stream(self, stream_id, header)
+                    self._streams[stream_id] = stream
+                    stream._feed(payload[OPEN_HEADER.size + hlen:])
+                    if flags & FLAG_FIN:
+                        stream._feed_eof()
+                    self._spawn(self._serve_stream(stream))
+                    continue
+                stream = self._streams.get(stream_id)
+                if stream is None:
+                    continue
+                if kind == DATA:
+                    if payload:
+                        stream._feed(payload)
+                    if flags & FLAG_FIN:
+                        stream._feed_eof()
+                elif kind == WINDOW:
+                    stream._grant(WINDOW_UPDATE.unpack(payload)[0])
+                elif kind == RESET:
+                    stream._reset(payload.decode())
+                    self._streams.pop(stream_id, None)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            for stream in self._streams.values():
+                stream._reset("session closed")
+            self._streams.clear()
+            self.writer.close()
+
+    async def _serve_stream(self, stream: Stream):
+        try:
+            if self.handler is None:
+                raise ValueError("Peer does not accept streams")
+            await self.handler(stream)
+            await stream.write_eof()
+        except Exception as e:
+            if not self.closed:
+                self._send_frame(stream.id, RESET, 0, str(e).encode())
+        finally:
+            self._streams.pop(stream.id, None)
+
+    async def wait_closed(self):
+        await asyncio.shield(self._reader_task)
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+        await self._reader_task
+
+
+class SessionPool:
+    """Reuses one `Session` per peer_id while it stays open."""
+
+    def __init__(self):
+        self._sessions: Dict[str, Session] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def get(self, peer_id: str, connect: Callable[[], Awaitable[Tuple]]) -> Session:
+        lock = self._locks.setdefault(peer_id, asyncio.Lock())
+        async with lock:
+            session = self._sessions.get(peer_id)
+            if session is None or session.closed:
+                reader, writer = await connect()
+                session = Session(reader, writer)
+                self._sessions[peer_id] = session
+            return session
+
+    async def close_all(self):
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            await session.close()
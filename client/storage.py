@@ -1,4 +1,7 @@
 from pathlib import Path
+from typing import Optional
+
+from packstore import PackStore
 
 def ensure_storage_dir(storage_dir: Path):
     storage_dir.mkdir(parents=True, exist_ok=True)
@@ -6,3 +9,9 @@ def ensure_storage_dir(storage_dir: Path):
 def validate_file_path(file_path: Path):
     if not file_path.exists():
         raise FileNotFoundError(f"File not found: {file_path}")
+
+def open_store(storage_dir: Path, quota_mb: Optional[int] = None) -> PackStore:
+    """Open the packfile object store in `storage_dir`, limited to `quota_mb` MB."""
+    ensure_storage_dir(storage_dir)
+    quota = quota_mb * 1024 * 1024 if quota_mb is not None else None
+    return PackStore(storage_dir, quota=quota)
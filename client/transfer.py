@@ -0,0 +1,245 @@
+import asyncio
+import json
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import merkle
+from packstore import MERKLE_PREFIX
+
+# Per-file header: name length, file size; a zero name length ends the batch.
+FILE_HEADER = struct.Struct("!HQ")
+# Batch summary sent back by the receiver: status, files stored, bytes stored, error length
+SUMMARY = struct.Struct("!BIQH")
+STATUS_OK, STATUS_ERROR = 0, 1
+
+CHUNK_SIZE = 256 * 1024
+READ_AHEAD = 16  # chunks buffered between the disk reader and the socket
+RANGE_SIZE = 8 * 1024 * 1024  # bytes per concurrent range fetch
+
+
+def iter_files(paths: Iterable[Path]) -> Iterator[Tuple[str, Path]]:
+    """Yield (object name, path) for files, walking directories recursively.
+
+    Files inside a directory are named relative to the directory's parent, so
+    sending `photos/` stores `photos/2023/a.jpg`.
+    """
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            for child in sorted(path.rglob("*")):
+                if child.is_file():
+                    yield child.relative_to(path.parent).as_posix(), child
+        else:
+            yield path.name, path
+
+
+def object_name(reservation_id: Optional[str], name: str) -> str:
+    """Name under which the host stores a requester's object.
+
+    Every reservation gets its own namespace, so requesters cannot overwrite
+    or read each other's objects, nor the store's internal ones.
+    """
+    if not reservation_id or "/" in reservation_id:
+        raise PermissionError("A reservation id is required")
+    if name.startswith(MERKLE_PREFIX) or "\0" in name:
+        raise PermissionError(f"Invalid object name: {name!r}")
+    return f"{reservation_id}/{name}"
+
+
+def _read_chunk(f, n: int, tree: merkle.MerkleBuilder) -> bytes:
+    chunk = f.read(n)
+    tree.update(chunk)
+    return chunk
+
+
+def describe(name: str, tree: merkle.MerkleBuilder, size: int) -> Dict:
+    """Merkle summary of an uploaded object, as reported to the server."""
+    leaves = tree.finish()
+    return {"name": name, "root": merkle.root(leaves).hex(), "leaves": len(leaves), "size": size}
+
+
+async def _read_files(files: List[Tuple[str, Path]], queue: asyncio.Queue, chunk_size: int, objects: List[Dict]):
+    """Read and hash files in a worker thread while the sender drains the queue."""
+    loop = asyncio.get_running_loop()
+    try:
+        for name, path in files:
+            f = await loop.run_in_executor(None, path.open, "rb")
+            try:
+                size = (await loop.run_in_executor(None, path.stat)).st_size
+                key = name.encode()
+                await queue.put(FILE_HEADER.pack(len(key), size) + key)
+                tree = merkle.MerkleBuilder()
+                remaining = size
+                while remaining:
+                    chunk = await loop.run_in_executor(None, _read_chunk, f, min(chunk_size, remaining), tree)
+                    if not chunk:
+                        raise ConnectionError(f"{path} shrank while sending")
+                    remaining -= len(chunk)
+                    await queue.put(chunk)
+                objects.append(describe(name, tree, size))
+            finally:
+                f.close()
+        await queue.put(FILE_HEADER.pack(0, 0))
+    finally:
+        await queue.put(None)
+
+
+async def send_files(reader, writer, files: Iterable[Tuple[str, Path]], chunk_size: int = CHUNK_SIZE,
+                     objects: Optional[List[Dict]] = None) -> Tuple[int, int]:
+    """Stream many files back to back and wait for a single batch summary.
+
+    Headers are pipelined with the data, so the only round trip is the
+    summary at the end. Each file's Merkle summary is appended to `objects`.
+    Returns (files stored, bytes stored).
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=READ_AHEAD)
+    objects = [] if objects is None else objects
+    producer = asyncio.create_task(_read_files(list(files), queue, chunk_size, objects))
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            writer.write(item)
+            await writer.drain()
+        await producer
+    finally:
+        producer.cancel()
+
+    status, count, total, err_len = SUMMARY.unpack(await reader.readexactly(SUMMARY.size))
+    if status != STATUS_OK:
+        raise ConnectionError(f"Peer rejected upload: {(await reader.readexactly(err_len)).decode()}")
+    return count, total
+
+
+async def receive_files(reader, writer, store, reservation_id: str,
+                        chunk_size: int = CHUNK_SIZE) -> Tuple[int, int]:
+    """Read a batch written by `send_files` into `store` and reply with a summary.
+
+    Files are stored in the namespace of `reservation_id` and synced to disk
+    once, before the summary acknowledges them. If storing fails (e.g. the
+    quota is exceeded) the rest of the batch is still consumed so the
+    summary can report the error.
+    """
+    count = total = 0
+    error = None
+    while True:
+        name_len, size = FILE_HEADER.unpack(await reader.readexactly(FILE_HEADER.size))
+        if name_len == 0:
+            break
+        name = (await reader.readexactly(name_len)).decode()
+        obj = None
+        if error is None:
+            try:
+                obj = store.writer(object_name(reservation_id, name), size)
+            except Exception as e:
+                error = f"{name}: {e}"
+        remaining = size
+        try:
+            while remaining:
+                chunk = await reader.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise ConnectionError("Connection closed mid-file")
+                remaining -= len(chunk)
+                if obj:
+                    obj.write(chunk)
+        except BaseException:
+            if obj:
+                obj.abort()
+            raise
+        if obj:
+            # Large objects are fsynced on commit; keep that off the event loop
+            await asyncio.to_thread(obj.commit)
+            count += 1
+            total += size
+
+    if count:
+        await asyncio.get_running_loop().run_in_executor(None, store.sync)
+    if error is None:
+        writer.write(SUMMARY.pack(STATUS_OK, count, total, 0))
+    else:
+        msg = error.encode()[:65535]
+        writer.write(SUMMARY.pack(STATUS_ERROR, count, total, len(msg)) + msg)
+    await writer.drain()
+    return count, total
+
+
+async def serve_range(stream, store, name: str):
+    """Answer a `get` stream for object `name` with bytes sent straight from the store's file."""
+    try:
+        f, base, size = store.open_object(name)
+    except KeyError:
+        raise FileNotFoundError(f"No such object: {stream.header['name']}")
+    with f:
+        offset = stream.header.get("offset", 0)
+        length = stream.header.get("length")
+        check_range(offset, length)
+        offset = min(offset, size)
+        end = size if length is None else min(size, offset + length)
+        await stream.sendfile(f, base + offset, end - offset)
+
+
+def check_range(offset, length):
+    """Reject a byte range that could reach outside the object."""
+    if not _is_count(offset) or not (length is None or _is_count(length)):
+        raise ValueError(f"Invalid byte range: offset={offset!r}, length={length!r}")
+
+
+def _is_count(value) -> bool:
+    return type(value) is int and value >= 0
+
+
+async def fetch_range(session, reservation_id: str, name: str, offset: int, length: int,
+                      fd: int, out_offset: int) -> int:
+    """Fetch `length` bytes of `name` from `offset` and pwrite them to `fd`."""
+    header = {"op": "get", "reservation_id": reservation_id, "name": name, "offset": offset, "length": length}
+    stream = await session.open_stream(header, fin=True)
+    received = 0
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        os.pwrite(fd, chunk, out_offset + received)
+        received += len(chunk)
+    if received != length:
+        raise ConnectionError(f"{name}: expected {length} bytes from {offset}, got {received}")
+    return received
+
+
+async def download(session, reservation_id: str, name: str, output: Path, offset: int = 0,
+                   length: Optional[int] = None, parallel: int = 4, range_size: int = RANGE_SIZE) -> int:
+    """Download `name` (or the byte range `offset`..`offset+length`) stored
+    under `reservation_id` into `output`.
+
+    The range is split into pieces fetched concurrently as separate streams
+    of the same session. Returns the number of bytes written.
+    """
+    check_range(offset, length)
+    if type(parallel) is not int or parallel < 1:
+        raise ValueError(f"parallel must be at least 1, got {parallel!r}")
+    size = json.loads(await session.request({"op": "stat", "reservation_id": reservation_id, "name": name}))["size"]
+    start = min(offset, size)
+    end = size if length is None else min(size, start + length)
+    limit = asyncio.Semaphore(parallel)
+
+    async def _fetch(piece_start: int, piece_len: int) -> int:
+        async with limit:
+            return await fetch_range(session, reservation_id, name, piece_start, piece_len, fd, piece_start - start)
+
+    fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    tasks = []
+    try:
+        os.ftruncate(fd, end - start)
+        pieces = [(p, min(range_size, end - p)) for p in range(start, end, range_size)]
+        tasks = [asyncio.ensure_future(_fetch(p, n)) for p, n in pieces]
+        results = await asyncio.gather(*tasks)
+    finally:
+        # gather() leaves the other fetches running when one fails; they
+        # must stop writing before fd is closed (and possibly reused)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        os.close(fd)
+    return sum(results)
@@ -0,0 +1,625 @@
+import asyncio
+import bisect
+import hashlib
+import ipaddress
+import os
+import socket
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+# --- STUN (RFC 5389 binding only) ---
+STUN_HEADER = struct.Struct("!HHI12s")
+STUN_MAGIC = 0x2112A442
+STUN_BINDING_REQUEST = 0x0001
+STUN_BINDING_RESPONSE = 0x0101
+STUN_XOR_MAPPED_ADDRESS = 0x0020
+STUN_ATTR = struct.Struct("!HH")
+STUN_XOR_ADDR = struct.Struct("!BBHI")
+
+# --- Reliable transport ---
+# Every datagram starts with the reservation token, the connection id the
+# requester picked for this session, and a packet type
+PACKET = struct.Struct("!8s8sB")
+PUNCH, PUNCH_ACK, DATA, ACK = 1, 2, 3, 4
+DATA_HEADER = struct.Struct("!IB")  # sequence number, flags
+FLAG_FIN = 1
+# cumulative ack (next expected seq), receive window (packets), SACK block count
+ACK_HEADER = struct.Struct("!IHB")
+SACK_BLOCK = struct.Struct("!II")  # [start, end) of packets held out of order
+MAX_SACK_BLOCKS = 16
+
+MSS = 1200
+INITIAL_CWND = 10
+RECV_WINDOW = 512  # packets
+SEND_BUFFER = 256 * MSS
+DUP_THRESH = 3
+MIN_RTO, MAX_RTO, INITIAL_RTO = 0.2, 10.0, 1.0
+MAX_TIMEOUTS = 8
+PUNCH_INTERVAL = 0.1
+PUNCH_TIMEOUT = 10.0
+KEEPALIVE_INTERVAL = 15.0  # also keeps NAT mappings open
+IDLE_TIMEOUT = 60.0  # a connection that heard nothing for this long is dropped
+
+# ICE type preferences (RFC 8445)
+TYPE_PREFERENCE = {"host": 126, "srflx": 100, "prflx": 110, "relay": 0}
+
+
+def parse_endpoint(endpoint: Optional[str]) -> Optional[Tuple[str, int]]:
+    """Turn "host:port" into a (host, port) tuple; None stays None."""
+    if not endpoint:
+        return None
+    host, port = endpoint.rsplit(":", 1)
+    return host, int(port)
+
+
+def connection_token(reservation_id: str) -> bytes:
+    """Token both peers derive from the reservation to tag their datagrams."""
+    return hashlib.sha256(reservation_id.encode()).digest()[:8]
+
+
+def make_candidate(ip: str, port: int, kind: str, local_preference: int = 65535) -> Dict:
+    """Build an ICE candidate dict in the shape of `models.ICECandidate`."""
+    return {
+        "foundation": hashlib.sha256(f"{kind}|{ip}".encode()).hexdigest()[:8],
+        "component": 1,
+        "protocol": "udp",
+        "priority": (TYPE_PREFERENCE[kind] << 24) + (local_preference << 8) + 255,
+        "ip": ip,
+        "port": port,
+        "type": kind,
+    }
+
+
+def candidate_addresses(candidates: List[Dict]) -> List[Tuple[str, int]]:
+    """UDP addresses of `candidates`, highest priority first, without duplicates."""
+    addrs = []
+    for c in sorted(candidates, key=lambda c: -c["priority"]):
+        addr = (str(c["ip"]), int(c["port"]))
+        if c.get("protocol", "udp") == "udp" and addr not in addrs:
+            addrs.append(addr)
+    return addrs
+
+
+def _stun_response(transaction: bytes, addr: Tuple[str, int]) -> bytes:
+    ip = int(ipaddress.IPv4Address(addr[0]))
+    value = STUN_XOR_ADDR.pack(0, 0x01, addr[1] ^ (STUN_MAGIC >> 16), ip ^ STUN_MAGIC)
+    attr = STUN_ATTR.pack(STUN_XOR_MAPPED_ADDRESS, len(value)) + value
+    return STUN_HEADER.pack(STUN_BINDING_RESPONSE, len(attr), STUN_MAGIC, transaction) + attr
+
+
+def _parse_stun(data: bytes) -> Optional[Tuple[int, bytes, Optional[Tuple[str, int]]]]:
+    """Return (message type, transaction id, mapped address) for STUN datagrams."""
+    if len(data) < STUN_HEADER.size or data[0] & 0xC0:
+        return None
+    kind, length, magic, transaction = STUN_HEADER.unpack_from(data)
+    if magic != STUN_MAGIC:
+        return None
+    pos, mapped = STUN_HEADER.size, None
+    while pos + STUN_ATTR.size <= STUN_HEADER.size + length:
+        attr, attr_len = STUN_ATTR.unpack_from(data, pos)
+        if attr == STUN_XOR_MAPPED_ADDRESS:
+            _, family, xport, xip = STUN_XOR_ADDR.unpack_from(data, pos + STUN_ATTR.size)
+            if family == 0x01:
+                mapped = (str(ipaddress.IPv4Address(xip ^ STUN_MAGIC)), xport ^ (STUN_MAGIC >> 16))
+        pos += STUN_ATTR.size + (attr_len + 3) // 4 * 4
+    return kind, transaction, mapped
+
+
+class StunServer(asyncio.DatagramProtocol):
+    """Minimal STUN binding server, e.g. as a local stand-in in tests."""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        parsed = _parse_stun(data)
+        if parsed and parsed[0] == STUN_BINDING_REQUEST:
+            self.transport.sendto(_stun_response(parsed[1], addr), addr)
+
+
+async def start_stun_server(host: str = "127.0.0.1", port: int = 3478):
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        StunServer, local_addr=(host, port)
+    )
+    return transport
+
+
+class UDPEndpoint(asyncio.DatagramProtocol):
+    """A UDP socket shared by STUN queries and any number of `UDPConnection`s.
+
+    Incoming datagrams are routed to connections by their token and
+    connection id. A `shared` endpoint closes itself with its last connection.
+    """
+
+    def __init__(self, shared: bool = False):
+        self.connections: Dict[Tuple[bytes, bytes], "UDPConnection"] = {}
+        self._stun_waiters: Dict[bytes, asyncio.Future] = {}
+        self.transport = None
+        self.shared = shared
+        self.closed = False
+        self._opened = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._opened.set()
+
+    @property
+    def local_address(self) -> Tuple[str, int]:
+        return self.transport.get_extra_info("sockname")[:2]
+
+    def datagram_received(self, data, addr):
+        parsed = _parse_stun(data)
+        if parsed:
+            waiter = self._stun_waiters.pop(parsed[1], None)
+            if waiter and not waiter.done() and parsed[0] == STUN_BINDING_RESPONSE:
+                waiter.set_result(parsed[2])
+            return
+        if len(data) < PACKET.size:
+            return
+        token, conn_id, kind = PACKET.unpack_from(data)
+        conn = self.connections.get((token, conn_id))
+        if conn:
+            conn._datagram(kind, data[PACKET.size:], addr)
+
+    def error_received(self, exc):
+        pass  # ICMP errors while punching towards unreachable candidates
+
+    async def stun(self, server: Tuple[str, int], timeout: float = 1.0, attempts: int = 3) -> Tuple[str, int]:
+        """Return this socket's public (ip, port) as seen by a STUN server."""
+        for _ in range(attempts):
+            transaction = os.urandom(12)
+            waiter = asyncio.get_running_loop().create_future()
+            self._stun_waiters[transaction] = waiter
+            self.transport.sendto(STUN_HEADER.pack(STUN_BINDING_REQUEST, 0, STUN_MAGIC, transaction), server)
+            try:
+                mapped = await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                self._stun_waiters.pop(transaction, None)
+            if mapped:
+                return mapped
+        raise ConnectionError(f"No STUN response from {server[0]}:{server[1]}")
+
+    async def gather_candidates(self, stun_server: Optional[Tuple[str, int]] = None,
+                                local_ip: Optional[str] = None) -> List[Dict]:
+        """Host candidate for this socket plus a server-reflexive one via STUN."""
+        ip, port = self.local_address
+        if ip in ("0.0.0.0", "::"):
+            ip = local_ip or socket.gethostbyname(socket.gethostname())
+        candidates = [make_candidate(ip, port, "host")]
+        if stun_server:
+            try:
+                public_ip, public_port = await self.stun(stun_server)
+                if (public_ip, public_port) != (ip, port):
+                    candidates.append(make_candidate(public_ip, public_port, "srflx"))
+            except ConnectionError as e:
+                print(f"STUN failed: {e}")
+        return candidates
+
+    def connection(self, token: bytes, conn_id: bytes) -> "UDPConnection":
+        """Return the connection for one session, creating it on first use.
+
+        The requester picks a random `conn_id` for every session, so a
+        reconnect never lands in the state of an earlier, dead session.
+        """
+        if self.closed:
+            raise ConnectionError("Endpoint closed")
+        conn = self.connections.get((token, conn_id))
+        if conn is None or conn.closed:
+            conn = UDPConnection(self, token, conn_id)
+            self.connections[conn.key] = conn
+        return conn
+
+    def _forget(self, conn: "UDPConnection"):
+        if self.connections.get(conn.key) is conn:
+            del self.connections[conn.key]
+        if self.shared and not self.connections:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for port, endpoint in list(_shared.items()):
+            if endpoint is self:
+                del _shared[port]
+        for conn in list(self.connections.values()):
+            conn._fail(ConnectionError("Endpoint closed"))
+        if self.transport:
+            self.transport.close()
+        self._opened.set()
+
+
+async def open_endpoint(local_port: int, host: str = "0.0.0.0") -> UDPEndpoint:
+    _, endpoint = await asyncio.get_running_loop().create_datagram_endpoint(
+        UDPEndpoint, local_addr=(host, local_port)
+    )
+    return endpoint
+
+
+# Endpoints of outgoing connections by local port, see `shared_endpoint`
+_shared: Dict[int, UDPEndpoint] = {}
+
+
+async def shared_endpoint(local_port: int, host: str = "0.0.0.0") -> UDPEndpoint:
+    """Return this process's endpoint on `local_port`, binding it on first use.
+
+    Sessions to different peers (or a reconnect to the same one) share the
+    socket instead of each binding the port again.
+    """
+    endpoint = _shared.get(local_port)
+    if endpoint is None or endpoint.closed:
+        endpoint = _shared[local_port] = UDPEndpoint(shared=True)
+        try:
+            await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: endpoint, local_addr=(host, local_port)
+            )
+        except OSError:
+            endpoint.close()
+            raise
+    await endpoint._opened.wait()
+    if endpoint.closed:
+        raise ConnectionError(f"UDP port {local_port} could not be opened")
+    return endpoint
+
+
+def close_shared_endpoints():
+    for endpoint in list(_shared.values()):
+        endpoint.close()
+    _shared.clear()
+
+
+class _Sent:
+    __slots__ = ("payload", "flags", "sent_at", "retransmitted", "sacked", "fast_retransmitted")
+
+    def __init__(self, payload: bytes, flags: int):
+        self.payload = payload
+        self.flags = flags
+        self.sent_at = 0.0
+        self.retransmitted = False
+        self.sacked = False
+        self.fast_retransmitted = False
+
+
+class UDPConnection:
+    """Reliable, congestion-controlled byte stream over a punched UDP path.
+
+    Data is cut into MSS-sized numbered packets. The receiver acknowledges
+    cumulatively plus selective (SACK) blocks; the sender retransmits a
+    packet once DUP_THRESH later packets were SACKed or its RTO expires, and
+    sizes its window NewReno-style (slow start, AIMD, halving on loss).
+
+    Offers the asyncio StreamReader/StreamWriter subset used by `Session`,
+    so the same object is passed as reader and writer. Once punched, an idle
+    connection sends keepalives and is dropped after IDLE_TIMEOUT of silence.
+    """
+
+    def __init__(self, endpoint: UDPEndpoint, token: bytes, conn_id: bytes):
+        self.endpoint = endpoint
+        self.token = token
+        self.conn_id = conn_id
+        self.key = (token, conn_id)
+        self.peer: Optional[Tuple[str, int]] = None
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self._peer_found = loop.create_future()
+        self._error: Optional[Exception] = None
+        self.closed = False
+        self._last_heard = self._last_sent = loop.time()
+        self._idle_timer: Optional[asyncio.TimerHandle] = None
+
+        # sender
+        self._next_seq = 0
+        self._unacked: Dict[int, _Sent] = {}
+        self._send_buf = bytearray()
+        self._fin_queued = False
+        self._fin_seq: Optional[int] = None
+        self._fin_acked = False
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self.cwnd = float(INITIAL_CWND)
+        self.ssthresh = float("inf")
+        self._recovery_point = -1
+        self._peer_window = RECV_WINDOW
+        self.srtt: Optional[float] = None
+        self._rttvar = 0.0
+        self.rto = INITIAL_RTO
+        self._timeouts = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        # receiver
+        self._expected = 0
+        self._out_of_order: Dict[int, Tuple[int, bytes]] = {}
+        self._buf = bytearray()
+        self._eof = False
+        self._readable = asyncio.Event()
+        self._window_closed = False
+
+    # --- hole punching ---
+    async def punch(self, addresses: List[Tuple[str, int]], timeout: float = PUNCH_TIMEOUT) -> Tuple[str, int]:
+        """Send PUNCH to every candidate until one answers (simultaneous open)."""
+        deadline = self._loop.time() + timeout
+        while not self._peer_found.done():
+            if self._loop.time() > deadline:
+                self._fail(ConnectionError("UDP hole punching timed out"))
+                break
+            for addr in addresses:
+                self._sendto(PUNCH, b"", addr)
+            try:
+                await asyncio.wait_for(asyncio.shield(self._peer_found), PUNCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        return self._peer_found.result()
+
+    def _set_peer(self, addr: Tuple[str, int]):
+        if self.peer is None:
+            self.peer = addr
+            self._peer_found.set_result(addr)
+            self._idle_timer = self._loop.call_later(KEEPALIVE_INTERVAL, self._check_idle)
+            self._pump()
+
+    def _check_idle(self):
+        now = self._loop.time()
+        if now - self._last_heard > IDLE_TIMEOUT:
+            self._fail(ConnectionError("Peer went silent"))
+            return
+        if now - self._last_sent >= KEEPALIVE_INTERVAL:
+            self._send_ack()
+        self._idle_timer = self._loop.call_later(KEEPALIVE_INTERVAL, self._check_idle)
+
+    # --- datagram handling ---
+    def _sendto(self, kind: int, payload: bytes, addr: Optional[Tuple[str, int]] = None):
+        if self.endpoint.transport and not self.endpoint.transport.is_closing():
+            self.endpoint.transport.sendto(PACKET.pack(self.token, self.conn_id, kind) + payload, addr or self.peer)
+            self._last_sent = self._loop.time()
+
+    def _datagram(self, kind: int, payload: bytes, addr: Tuple[str, int]):
+        if self.peer in (None, addr):
+            self._last_heard = self._loop.time()
+        if kind == PUNCH:
+            self._set_peer(addr)
+            self._sendto(PUNCH_ACK, b"", addr)
+            return
+        if kind == PUNCH_ACK:
+            self._set_peer(addr)
+            return
+        if addr != self.peer:
+            if self.peer is not None:
+                return
+            self._set_peer(addr)
+        if kind == DATA:
+            self._on_data(payload)
+        elif kind == ACK:
+            self._on_ack(payload)
+
+    # --- receiving ---
+    def _receive_window(self) -> int:
+        return max(0, RECV_WINDOW - len(self._buf) // MSS - len(self._out_of_order))
+
+    def _on_data(self, payload: bytes):
+        seq, flags = DATA_HEADER.unpack_from(payload)
+        data = payload[DATA_HEADER.size:]
+        if seq == self._expected:
+            self._deliver(flags, data)
+            while self._expected in self._out_of_order:
+                self._deliver(*self._out_of_order.pop(self._expected))
+        elif seq > self._expected and seq - self._expected < RECV_WINDOW:
+            self._out_of_order.setdefault(seq, (flags, data))
+        self._send_ack()
+        self._check_closed()
+
+    def _deliver(self, flags: int, data: bytes):
+        self._expected += 1
+        self._buf += data
+        if flags & FLAG_FIN:
+            self._eof = True
+        self._readable.set()
+
+    def _send_ack(self):
+        blocks = []
+        for seq in sorted(self._out_of_order):
+            if blocks and blocks[-1][1] == seq:
+                blocks[-1][1] = seq + 1
+            else:
+                blocks.append([seq, seq + 1])
+        # The most recent holes matter most to the sender
+        blocks = blocks[-MAX_SACK_BLOCKS:]
+        window = self._receive_window()
+        self._window_closed = window == 0
+        self._sendto(
+            ACK,
+            ACK_HEADER.pack(self._expected, window, len(blocks))
+            + b"".join(SACK_BLOCK.pack(a, b) for a, b in blocks),
+        )
+
+    async def read(self, n: int = -1) -> bytes:
+        while not self._buf and not self._eof and not self._error:
+            self._readable.clear()
+            await self._readable.wait()
+        if self._error and not self._buf:
+            raise self._error
+        n = len(self._buf) if n < 0 else n
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        if self._window_closed and self._receive_window() > 0:
+            self._send_ack()  # window update
+        return data
+
+    async def readexactly(self, n: int) -> bytes:
+        data = bytearray()
+        while len(data) < n:
+            chunk = await self.read(n - len(data))
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(data), n)
+            data += chunk
+        return bytes(data)
+
+    # --- sending ---
+    def write(self, data: bytes):
+        if self._fin_queued:
+            raise ConnectionError("Connection closed for writing")
+        self._send_buf += data
+        if len(self._send_buf) >= SEND_BUFFER:
+            self._writable.clear()
+        self._pump()
+
+    async def drain(self):
+        await self._writable.wait()
+        if self._error:
+            raise self._error
+
+    def _in_flight(self) -> int:
+        return sum(1 for s in self._unacked.values() if not s.sacked)
+
+    def _pump(self):
+        if self.peer is None or self._error:
+            return
+        limit = max(1, min(int(self.cwnd), self._peer_window))
+        in_flight = self._in_flight()
+        while in_flight < limit and (self._send_buf or (self._fin_queued and self._fin_seq is None)):
+            payload = bytes(self._send_buf[:MSS])
+            del self._send_buf[:MSS]
+            flags = 0
+            if self._fin_queued and not self._send_buf:
+                flags = FLAG_FIN
+                self._fin_seq = self._next_seq
+            sent = _Sent(payload, flags)
+            self._unacked[self._next_seq] = sent
+            self._transmit(self._next_seq, sent)
+            self._next_seq += 1
+            in_flight += 1
+        if len(self._send_buf) < SEND_BUFFER:
+            self._writable.set()
+        if self._unacked and self._timer is None:
+            self._arm_timer()
+
+    def _transmit(self, seq: int, sent: _Sent):
+        sent.sent_at = time.monotonic()
+        self._sendto(DATA, DATA_HEADER.pack(seq, sent.flags) + sent.payload)
+
+    def _on_ack(self, payload: bytes):
+        cumulative, window, count = ACK_HEADER.unpack_from(payload)
+        blocks = [SACK_BLOCK.unpack_from(payload, ACK_HEADER.size + i * SACK_BLOCK.size) for i in range(count)]
+        self._peer_window = window
+        now = time.monotonic()
+        newly_acked = 0
+
+        for seq in [s for s in self._unacked if s < cumulative]:
+            sent = self._unacked.pop(seq)
+            if sent.flags & FLAG_FIN:
+                self._fin_acked = True
+            if not sent.sacked:
+                newly_acked += 1
+                if not sent.retransmitted:
+                    self._rtt_sample(now - sent.sent_at)
+        for start, end in blocks:
+            for seq in range(max(start, cumulative), end):
+                sent = self._unacked.get(seq)
+                if sent and not sent.sacked:
+                    sent.sacked = True
+                    newly_acked += 1
+                    if not sent.retransmitted:
+                        self._rtt_sample(now - sent.sent_at)
+
+        if newly_acked:
+            self._timeouts = 0
+            for _ in range(newly_acked):
+                self.cwnd += 1 if self.cwnd < self.ssthresh else 1 / self.cwnd
+            self._cancel_timer()
+        self._detect_losses()
+        self._pump()
+        if self._unacked and self._timer is None:
+            self._arm_timer()
+        self._check_closed()
+
+    def _detect_losses(self):
+        sacked = sorted(seq for seq, s in self._unacked.items() if s.sacked)
+        if not sacked:
+            return
+        for seq, sent in self._unacked.items():
+            if sent.sacked or sent.fast_retransmitted or seq > sacked[-1]:
+                continue
+            if len(sacked) - bisect.bisect_right(sacked, seq) >= DUP_THRESH:
+                self._on_loss(seq)
+                sent.fast_retransmitted = sent.retransmitted = True
+                self._transmit(seq, sent)
+
+    def _on_loss(self, seq: int):
+        # Halve the window once per round trip of losses
+        if seq > self._recovery_point:
+            self.ssthresh = max(self.cwnd / 2, 2.0)
+            self.cwnd = self.ssthresh
+            self._recovery_point = self._next_seq - 1
+
+    def _rtt_sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt, self._rttvar = rtt, rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self._rttvar))
+
+    def _arm_timer(self):
+        self._cancel_timer()
+        self._timer = self._loop.call_later(self.rto, self._on_timeout)
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timeout(self):
+        self._timer = None
+        if not self._unacked:
+            return
+        self._timeouts += 1
+        if self._timeouts > MAX_TIMEOUTS:
+            self._fail(ConnectionError("Peer stopped acknowledging"))
+            return
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = 1.0
+        self._recovery_point = self._next_seq - 1
+        self.rto = min(MAX_RTO, self.rto * 2)
+        seq = next((s for s, sent in self._unacked.items() if not sent.sacked), None)
+        if seq is not None:
+            sent = self._unacked[seq]
+            sent.retransmitted = True
+            self._transmit(seq, sent)
+        self._arm_timer()
+
+    # --- teardown ---
+    def close(self):
+        """Send FIN after buffered data; the peer reads EOF."""
+        if not self._fin_queued:
+            self._fin_queued = True
+            self._pump()
+
+    def abort(self):
+        """Drop the connection without a FIN, e.g. when setting it up failed."""
+        if not self.closed:
+            self._fail(ConnectionError("Connection aborted"))
+
+    def _check_closed(self):
+        if self._fin_acked and self._eof and not self.closed:
+            self.closed = True
+            self._stop_timers()
+            self.endpoint._forget(self)
+
+    def _stop_timers(self):
+        self._cancel_timer()
+        if self._idle_timer:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _fail(self, error: Exception):
+        self._error = error
+        self.closed = True
+        self._stop_timers()
+        self._readable.set()
+        self._writable.set()
+        if not self._peer_found.done():
+            self._peer_found.set_exception(error)
+            self._peer_found.exception()  # punch() may not be waiting for it
+        self.endpoint._forget(self)
@@ -0,0 +1,22 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The client modules import each other as top-level modules (they are run as
+# scripts from client/), so make them importable the same way in tests.
+sys.path.insert(0, str(Path(__file__).parent / "client"))
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    """TestClient for the server app, with empty tables persisted under tmp_path."""
+    from fastapi.testclient import TestClient
+    import server
+
+    monkeypatch.setattr(server, "CLIENTS_DB_PATH", tmp_path / "clients.json")
+    for table in ("clients", "client_versions", "removed_clients", "reservations", "objects", "challenges"):
+        monkeypatch.setattr(server, table, {})
+    monkeypatch.setattr(server, "table_version", 0)
+    with TestClient(server.app) as client:
+        yield client
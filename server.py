@@ -1,11 +1,17 @@
-from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from pydantic import BaseModel, Field
 import uuid
-from typing import List
+from typing import List, Optional
 from fastapi import Query
 import json
+import base64
+import random
+import threading
+import time
 from pathlib import Path
 
+from client.merkle import verify as verify_proof
+
 
 app = FastAPI()
 
@@ -37,6 +43,32 @@ class PendingRequest(BaseModel):
     from_id: str
     amount: int
 
+class CandidatesAnnouncement(BaseModel):
+    requester: str
+    candidates: List[dict]  # ICE candidates of the requester's UDP socket
+    connection_id: str  # hex id the requester picked for this UDP session
+
+class StoredObject(BaseModel):
+    name: str
+    root: str  # hex Merkle root over 4 KiB leaves
+    leaves: int = Field(..., gt=0)
+    size: int = Field(..., ge=0)
+
+class ObjectsReport(BaseModel):
+    requester: str
+    objects: List[StoredObject]
+
+MAX_CHALLENGES = 100  # per request
+CHALLENGE_TTL = 600  # seconds a host has to answer before the challenge fails
+
+class ChallengeRequest(BaseModel):
+    reservation_id: str
+    count: int = Field(1, ge=1, le=MAX_CHALLENGES)
+
+class ChallengeAnswer(BaseModel):
+    leaf: str  # base64 leaf bytes
+    proof: List[str]  # hex sibling hashes, leaf to root
+
 # --- In-memory stores ---
 CLIENTS_DB_PATH = Path("clients.json")
 
@@ -45,50 +77,131 @@ def load_clients():
         with CLIENTS_DB_PATH.open("r") as f:
             data = json.load(f)
             # Convert dicts to RegisterRequest objects
-            return {cid: RegisterRequest(**cdata) for cid, cdata in data.get("clients", {}).items()}
-    return {}
+            clients = {cid: RegisterRequest(**cdata) for cid, cdata in data.get("clients", {}).items()}
+            # Files written before versioning get one version per client
+            versions = data.get("versions") or {cid: i + 1 for i, cid in enumerate(clients)}
+            removed = data.get("removed", {})
+            version = data.get("version", max([0, *versions.values(), *removed.values()]))
+            return clients, versions, removed, version
+    return {}, {}, {}, 0
 
 def save_clients(clients_dict):
     # Convert RegisterRequest objects to dicts
-    data = {"clients": {cid: c.dict() for cid, c in clients_dict.items()}}
+    data = {
+        "version": table_version,
+        "clients": {cid: c.dict() for cid, c in clients_dict.items()},
+        "versions": client_versions,
+        "removed": removed_clients,
+    }
     with CLIENTS_DB_PATH.open("w") as f:
         json.dump(data, f, indent=2)
 
-clients: dict[str, RegisterRequest] = load_clients()
+# table_version increases on every change to the peer table; client_versions
+# and removed_clients record the version at which each peer last changed
+# Sync endpoints run on a thread pool; peer table changes and their save
+# to disk happen under peers_lock, readers iterate over copies
+peers_lock = threading.Lock()
+clients: dict[str, RegisterRequest]
+client_versions: dict[str, int]
+removed_clients: dict[str, int]
+clients, client_versions, removed_clients, table_version = load_clients()
+
+def bump_version(client_id: str, removed: bool = False):
+    global table_version
+    table_version += 1
+    if removed:
+        client_versions.pop(client_id, None)
+        removed_clients[client_id] = table_version
+    else:
+        removed_clients.pop(client_id, None)
+        client_versions[client_id] = table_version
 
 reservations: dict[str, dict] = {}
 # reservations[rid] = {
 #   "from_id": str, "to_id": str, "amount": int,
-#   "approved": bool, "secret_info": str|None
+#   "approved": bool, "secret_info": str|None,
+#   "announcements": list  (requester's UDP sessions not yet seen by the host)
 # }
 
+objects: dict[str, dict[str, StoredObject]] = {}
+# objects[rid][name] = Merkle summary reported by the uploader
+
+challenges: dict[str, dict] = {}
+# challenges[cid] = {
+#   "host_id": str, "reservation_id": str, "name": str, "leaf": int,
+#   "status": "pending"|"passed"|"failed", "expires": float (epoch seconds),
+#   "expired": bool  (failed for lack of an answer before "expires")
+# }
+
+def expire_challenges():
+    """Fail the pending challenges whose deadline has passed"""
+    now = time.time()
+    for c in challenges.values():
+        if c["status"] == "pending" and c["expires"] < now:
+            c["status"], c["expired"] = "failed", True
+
 # --- Endpoints ---
 @app.post("/register", status_code=201)
 def register(req: RegisterRequest):
-    if req.id in clients:
-        raise HTTPException(400, f"Client {req.id} already registered")
-    clients[req.id] = req
-    save_clients(clients)
+    with peers_lock:
+        if req.id in clients:
+            raise HTTPException(400, f"Client {req.id} already registered")
+        clients[req.id] = req
+        bump_version(req.id)
+        save_clients(clients)
     return {"status": "registered"}
 
-@app.get("/offers", response_model=List[Offer])
+@app.delete("/register/{client_id}")
+def unregister(client_id: str):
+    with peers_lock:
+        if client_id not in clients:
+            raise HTTPException(404, "Client not found")
+        del clients[client_id]
+        bump_version(client_id, removed=True)
+        save_clients(clients)
+    return {"status": "unregistered"}
+
+def to_offer(client: RegisterRequest) -> Offer:
+    return Offer(id=client.id, endpoint=client.endpoint, free_space=client.available_space)
+
+@app.get("/offers")
 def list_offers(
-    min_space: int = Query(0, description="Minimum free space in MB")
+    request: Request,
+    response: Response,
+    min_space: int = Query(0, description="Minimum free space in MB"),
+    since: Optional[int] = Query(None, description="Return only changes after this version"),
 ):
     """
     Return all registered peers offering at least `min_space` MB.
+
+    The ETag is the peer table version plus the query shape (filter and
+    full list vs. delta), so `If-None-Match` gets a 304 only while nothing
+    changed for that same query. With `since`, only peers added, changed or
+    removed after that version are returned, together with the current version.
     """
-    results: List[Offer] = []
-    for client in clients.values():
-        if client.available_space >= min_space:
-            results.append(
-                Offer(
-                    id=client.id,
-                    endpoint=client.endpoint,
-                    free_space=client.available_space,
-                )
-            )
-    return results
+    with peers_lock:
+        version, peers = table_version, dict(clients)
+        versions, removed_at = dict(client_versions), dict(removed_clients)
+    etag = f'"{version}-{min_space}{"" if since is None else "-delta"}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    if since is None:
+        return [to_offer(c) for c in peers.values() if c.available_space >= min_space]
+
+    # A client ahead of us (e.g. after a server reset) must start over
+    reset = since > version
+    changed: List[Offer] = []
+    removed = [cid for cid, v in removed_at.items() if v > since and not reset]
+    for cid, client in peers.items():
+        if reset or versions[cid] > since:
+            if client.available_space >= min_space:
+                changed.append(to_offer(client))
+            else:
+                # No longer matches this client's filter
+                removed.append(cid)
+    return {"version": version, "reset": reset, "changed": changed, "removed": removed}
+
 @app.post("/reserve")
 def reserve(req: ReserveRequest):
     peer = clients.get(req.to_id)
@@ -103,6 +216,7 @@ def reserve(req: ReserveRequest):
         "amount": req.amount,
         "approved": False,
         "secret_info": None,
+        "announcements": [],
     }
     return {"reservation_id": rid}
 
@@ -118,6 +232,15 @@ def get_requests(for_peer: str = Query(..., alias="for")):
         if data["to_id"] == for_peer and not data["approved"]
     ]
 
+@app.get("/reservations")
+def get_reservations(for_peer: str = Query(..., alias="for")):
+    """List the approved reservations hosted by `for`, with their amounts in MB"""
+    return [
+        {"reservation_id": rid, "from_id": data["from_id"], "amount": data["amount"]}
+        for rid, data in reservations.items()
+        if data["to_id"] == for_peer and data["approved"]
+    ]
+
 @app.post("/requests/{reservation_id}/approve")
 def approve_request(reservation_id: str, req: ApprovalRequest):
     """Store the raw connection secret info from the peer (expects new format)"""
@@ -141,4 +264,98 @@ def get_secret(reservation_id: str, requester: str = Query(...)):
     if data["from_id"] != requester:
         raise HTTPException(403, "Not your reservation")
     # Return the raw secret_info dict without modification (expects new format)
-    return SecretInfo(secret_info=data["secret_info"]).dict()
\ No newline at end of file
+    return SecretInfo(secret_info=data["secret_info"]).dict()
+
+@app.post("/requests/{reservation_id}/candidates")
+def announce_candidates(reservation_id: str, req: CandidatesAnnouncement):
+    """Queue the requester's UDP candidates so the host can punch back"""
+    data = reservations.get(reservation_id)
+    if not data or not data["approved"]:
+        raise HTTPException(404, "Reservation not approved")
+    if data["from_id"] != req.requester:
+        raise HTTPException(403, "Not your reservation")
+    data["announcements"].append({"connection_id": req.connection_id, "candidates": req.candidates})
+    return {"status": "announced"}
+
+@app.get("/candidates")
+def get_candidates(for_peer: str = Query(..., alias="for")):
+    """Hand out (once) the UDP sessions announced for reservations hosted by `for`"""
+    announced = []
+    for rid, data in reservations.items():
+        if data["to_id"] == for_peer:
+            announced += [{"reservation_id": rid, **a} for a in data["announcements"]]
+            data["announcements"] = []
+    return announced
+
+@app.post("/reservations/{reservation_id}/objects")
+def report_objects(reservation_id: str, req: ObjectsReport):
+    """Record the Merkle roots of objects uploaded under a reservation"""
+    data = reservations.get(reservation_id)
+    if not data:
+        raise HTTPException(404, "Reservation not found")
+    if data["from_id"] != req.requester:
+        raise HTTPException(403, "Not your reservation")
+    stored = objects.setdefault(reservation_id, {})
+    for obj in req.objects:
+        stored[obj.name] = obj
+    return {"status": "recorded", "objects": len(stored)}
+
+@app.post("/challenges")
+def issue_challenges(req: ChallengeRequest):
+    """Challenge the host of a reservation to prove it holds random leaves"""
+    data = reservations.get(req.reservation_id)
+    if not data:
+        raise HTTPException(404, "Reservation not found")
+    stored = list(objects.get(req.reservation_id, {}).values())
+    if not stored:
+        raise HTTPException(400, "No objects recorded for this reservation")
+    issued = []
+    for obj in random.choices(stored, k=req.count):
+        cid = uuid.uuid4().hex
+        challenges[cid] = {
+            "host_id": data["to_id"],
+            "reservation_id": req.reservation_id,
+            "name": obj.name,
+            "leaf": random.randrange(obj.leaves),
+            "status": "pending",
+            "expires": time.time() + CHALLENGE_TTL,
+            "expired": False,
+        }
+        issued.append({"challenge_id": cid, **challenges[cid]})
+    return issued
+
+@app.get("/challenges")
+def get_challenges(for_peer: str = Query(..., alias="for")):
+    expire_challenges()
+    return [
+        {"challenge_id": cid, "reservation_id": c["reservation_id"], "name": c["name"], "leaf": c["leaf"]}
+        for cid, c in challenges.items()
+        if c["host_id"] == for_peer and c["status"] == "pending"
+    ]
+
+@app.post("/challenges/{challenge_id}/answer")
+def answer_challenge(challenge_id: str, req: ChallengeAnswer):
+    """Check a host's leaf and Merkle proof against the uploader's root"""
+    c = challenges.get(challenge_id)
+    if not c:
+        raise HTTPException(404, "Challenge not found")
+    expire_challenges()
+    if c["status"] != "pending":
+        raise HTTPException(400, "Challenge expired" if c["expired"] else "Already answered")
+    obj = objects[c["reservation_id"]][c["name"]]
+    try:
+        leaf = base64.b64decode(req.leaf)
+        proof = [bytes.fromhex(h) for h in req.proof]
+    except ValueError:
+        raise HTTPException(400, "Malformed answer")
+    passed = verify_proof(bytes.fromhex(obj.root), leaf, c["leaf"], obj.leaves, proof)
+    c["status"] = "passed" if passed else "failed"
+    return {"challenge_id": challenge_id, "status": c["status"]}
+
+@app.get("/challenges/{challenge_id}")
+def get_challenge(challenge_id: str):
+    c = challenges.get(challenge_id)
+    if not c:
+        raise HTTPException(404, "Challenge not found")
+    expire_challenges()
+    return {"challenge_id": challenge_id, **c}
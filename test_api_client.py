@@ -16,6 +16,26 @@ def test_list_offers(mock_get):
     assert result[0]['id'] == 'peer1'
     mock_get.assert_called_once()
 
+@patch('httpx.get')
+def test_offers_mirror_applies_deltas(mock_get):
+    mirror = api_client.OffersMirror('http://localhost:8000')
+    mock_get.return_value = MagicMock(status_code=200, headers={'ETag': '"2"'}, json=lambda: {
+        'version': 2, 'reset': False, 'removed': [],
+        'changed': [{'id': 'peer1', 'free_space': 50, 'endpoint': 'a:1'}, {'id': 'peer2', 'free_space': 10, 'endpoint': 'b:1'}],
+    })
+    assert mirror.refresh() is True
+    mock_get.return_value = MagicMock(status_code=200, headers={'ETag': '"4"'}, json=lambda: {
+        'version': 4, 'reset': False, 'removed': ['peer2'],
+        'changed': [{'id': 'peer1', 'free_space': 40, 'endpoint': 'a:1'}],
+    })
+    assert mirror.refresh() is True
+    assert mock_get.call_args.kwargs['params']['since'] == 2
+    assert mock_get.call_args.kwargs['headers'] == {'If-None-Match': '"2"'}
+    mock_get.return_value = MagicMock(status_code=304)
+    assert mirror.refresh() is False
+    assert mirror.version == 4
+    assert mirror.offers() == [{'id': 'peer1', 'free_space': 40, 'endpoint': 'a:1'}]
+
 @patch('httpx.post')
 def test_reserve(mock_post):
     mock_post.return_value = MagicMock(status_code=200, json=lambda: {'reservation_id': 'abc'})
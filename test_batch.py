@@ -0,0 +1,89 @@
+import asyncio
+import io
+import json
+from unittest.mock import patch
+import pytest
+import api_client
+import batch
+
+def _run(lines, operations, concurrency=4):
+    out = io.StringIO()
+    with patch.dict(batch.OPERATIONS, operations):
+        results = asyncio.run(batch.run_batch(batch.parse_operations(lines), out, 'http://localhost:8000', concurrency))
+    return results, [json.loads(line) for line in out.getvalue().splitlines()]
+
+def test_references_and_concurrency_limit():
+    running = []
+    peak = []
+
+    async def reserve(args, server):
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+        return {'reservation_id': f"r-{args['to_id']}"}
+
+    async def connect(args, server):
+        return {'files': 1, 'bytes': len(args['reservation_id'])}
+
+    lines = [json.dumps({'id': f'res{i}', 'op': 'reserve', 'args': {'from_id': 'a', 'to_id': f'p{i}', 'amount': 1}}) for i in range(10)]
+    lines.append(json.dumps({'id': 'send', 'op': 'p2p-connect', 'args': {'reservation_id': '${res3.reservation_id}', 'client_id': 'a'}}))
+    results, out = _run(lines, {'reserve': reserve, 'p2p-connect': connect}, concurrency=4)
+    assert len(out) == 11
+    order = [line['id'] for line in out]
+    assert order.index('send') > order.index('res3')
+    assert results['send']['result'] == {'files': 1, 'bytes': len('r-p3')}
+    assert max(peak) == 4
+
+def test_failed_dependency_fails_dependents():
+    async def reserve(args, server):
+        raise ValueError('Insufficient space')
+
+    async def connect(args, server):
+        raise AssertionError('must not run')
+
+    lines = [
+        '{"id": "r", "op": "reserve", "args": {}}',
+        '{"id": "c", "op": "p2p-connect", "args": {}, "after": ["r"]}',
+    ]
+    results, out = _run(lines, {'reserve': reserve, 'p2p-connect': connect})
+    assert results['r'] == {'id': 'r', 'op': 'reserve', 'ok': False, 'error': 'Insufficient space', 'elapsed': results['r']['elapsed']}
+    assert results['c']['error'] == 'dependency r failed'
+
+def test_invalid_batches_are_rejected():
+    with pytest.raises(ValueError, match='unknown operation'):
+        batch.parse_operations(['{"op": "fly"}'])
+    ops = batch.parse_operations([
+        '{"id": "a", "op": "offers", "after": ["b"]}',
+        '{"id": "b", "op": "offers", "after": ["a"]}',
+    ])
+    with pytest.raises(ValueError, match='cycle'):
+        asyncio.run(batch.run_batch(ops, io.StringIO(), 'http://localhost:8000'))
+
+def test_real_operations_through_shared_pools(api):
+    from fastapi.testclient import TestClient
+    import server
+
+    secret = {'peer_id': 'bob-peer', 'public_endpoint': '127.0.0.1:9003'}
+    lines = [
+        '{"id": "bob", "op": "register", "args": {"client_id": "bob", "endpoint": "127.0.0.1:9003", "space": 100}}',
+        '{"id": "alice", "op": "register", "args": {"client_id": "alice", "endpoint": "127.0.0.1:9002", "space": 10}}',
+        '{"id": "offers", "op": "offers", "args": {"min_space": 50}, "after": ["bob", "alice"]}',
+        '{"id": "res", "op": "reserve", "args": {"from_id": "alice", "to_id": "bob", "amount": 20}, "after": ["bob"]}',
+        '{"id": "pending", "op": "requests", "args": {"client_id": "bob"}, "after": ["res"]}',
+        '{"id": "approve", "op": "approve", "args": {"reservation_id": "${res.reservation_id}"}, "after": ["pending"]}',
+    ]
+    out = io.StringIO()
+    # Every pooled() sync call reaches the app in-process; NAT discovery is skipped
+    with patch.object(api_client.httpx, 'Client', lambda limits: TestClient(server.app)), \
+            patch.object(batch, 'get_secret_data', return_value=secret):
+        results = asyncio.run(batch.run_batch(batch.parse_operations(lines), out, 'http://testserver'))
+    assert all(r['ok'] for r in results.values()), results
+    assert api_client._http is api_client.httpx
+    rid = results['res']['result']['reservation_id']
+    assert results['offers']['result'] == [{'id': 'bob', 'endpoint': '127.0.0.1:9003', 'free_space': 100}]
+    assert results['pending']['result'] == [{'reservation_id': rid, 'from_id': 'alice', 'amount': 20}]
+    assert results['approve']['result'] == {'status': 'approved', 'peer_id': 'bob-peer'}
+    assert server.reservations[rid]['approved']
+    assert server.reservations[rid]['secret_info'] == secret
+    assert len(out.getvalue().splitlines()) == 6
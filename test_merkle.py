@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import pytest
+import api_client
+import merkle
+import p2p_ops
+from packstore import PackStore
+
+@pytest.mark.parametrize('size', [0, 1, 4096, 4097, 5 * 4096 + 7, 64 * 4096])
+def test_every_leaf_proof_verifies(size):
+    data = bytes(i % 251 for i in range(size))
+    tree = merkle.MerkleBuilder()
+    for i in range(0, size, 1000):
+        tree.update(data[i:i + 1000])
+    leaves = tree.finish()
+    root = merkle.root(leaves)
+    for index in range(len(leaves)):
+        leaf = data[index * merkle.LEAF_SIZE:(index + 1) * merkle.LEAF_SIZE]
+        proof = merkle.prove(leaves, index)
+        assert merkle.verify(root, leaf, index, len(leaves), proof)
+        assert not merkle.verify(root, leaf + b'x', index, len(leaves), proof)
+
+def test_store_proves_and_scrubs(tmp_path):
+    data = b'a' * (10 * merkle.LEAF_SIZE + 3)
+    tree = merkle.MerkleBuilder()
+    tree.update(data)
+    leaves = tree.finish()
+    store = PackStore(tmp_path, small_limit=1024)
+    store.put('blob', data)
+    store.put('tiny', b'hi')
+    assert store.merkle_root('blob') == merkle.root(leaves)
+    assert sorted(store.names()) == ['blob', 'tiny']
+    leaf, proof = store.prove('blob', 10)
+    assert merkle.verify(merkle.root(leaves), leaf, 10, len(leaves), proof)
+    assert store.scrub(rate=None) == set()
+
+    path, offset, _ = store.locate('blob')
+    with open(path, 'r+b') as f:
+        f.seek(offset + 5 * merkle.LEAF_SIZE)
+        f.write(b'b')
+    assert store.verify('blob') == [5]
+    assert store.scrub(rate=None) == {'blob'}
+    store.delete('blob')
+    assert store.used == 2
+    store.close()
+
+def test_interrupted_scrub_has_no_verdict(tmp_path):
+    store = PackStore(tmp_path)
+    store.put('blob', b'a' * (20 * merkle.LEAF_SIZE))
+    stopper = threading.Timer(0.2, store._stop.set)
+    stopper.start()
+    assert store.scrub(rate=10 * merkle.LEAF_SIZE) == set()
+    assert store.verify('blob', rate=merkle.LEAF_SIZE) is None
+    store.close()
+
+def test_scrubber_reports_and_survives_failures(tmp_path):
+    store = PackStore(tmp_path)
+    outcomes = iter([FileNotFoundError('pack-000001.dat'), {'blob'}])
+    reported = []
+
+    def scrub(rate):
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    store.scrub = scrub
+    done = threading.Event()
+    store.start_scrubber(interval=0.01, on_scrubbed=lambda corrupt: (reported.append(corrupt), done.set()))
+    assert done.wait(5)
+    store.close()
+    assert reported == [{'blob'}]
+
+def test_serve_answers_challenges_from_its_store(api, tmp_path, monkeypatch):
+    data = bytes(i % 251 for i in range(5 * merkle.LEAF_SIZE))
+    tree = merkle.MerkleBuilder()
+    tree.update(data)
+    api.post('/register', json={'id': 'bob', 'endpoint': 'bob:1', 'available_space': 100})
+    rid = api.post('/reserve', json={'from_id': 'alice', 'to_id': 'bob', 'amount': 20}).json()['reservation_id']
+    with PackStore(tmp_path) as store:
+        store.put(f'{rid}/a.bin', data)
+    root = merkle.root(tree.finish()).hex()
+    api.post(f'/reservations/{rid}/objects', json={'requester': 'alice', 'objects': [
+        {'name': 'a.bin', 'root': root, 'leaves': 5, 'size': len(data)},
+    ]})
+    issued = [c['challenge_id'] for c in api.post('/challenges', json={'reservation_id': rid, 'count': 3}).json()]
+    monkeypatch.setattr(api_client, '_http', api)
+    monkeypatch.setattr(p2p_ops, 'CHALLENGE_POLL_INTERVAL', 0.05)
+
+    async def run():
+        serving = asyncio.create_task(p2p_ops.p2p_serve(0, tmp_path, client_id='bob', server_url='http://testserver'))
+        for _ in range(100):
+            statuses = [api.get(f'/challenges/{cid}').json()['status'] for cid in issued]
+            if 'pending' not in statuses:
+                break
+            await asyncio.sleep(0.05)
+        with pytest.raises(RuntimeError, match='already open'):
+            p2p_ops.answer_challenges('bob', tmp_path, 'http://testserver')
+        serving.cancel()
+        return statuses
+
+    assert asyncio.run(asyncio.wait_for(run(), 20)) == ['passed'] * 3
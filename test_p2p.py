@@ -0,0 +1,29 @@
+import asyncio
+import httpx
+import pytest
+from cryptography.exceptions import InvalidSignature
+import api_client
+import p2p
+
+def _fetch(monkeypatch, secret_info):
+    def handler(request):
+        return httpx.Response(200, json={'secret_info': secret_info})
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            monkeypatch.setattr(api_client, '_async_http', client)
+            return await p2p.fetch_peer_secret('rid', 'alice', 'http://server')
+
+    return asyncio.run(run())
+
+def test_secret_signature_covers_ice_candidates(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(p2p.NATTraversal, 'setup_upnp', lambda self: '203.0.113.5')
+    monkeypatch.setattr(p2p.NATTraversal, '_get_local_ip', lambda self: '192.168.1.2')
+    secret = p2p.get_secret_data(4000, 'rid')
+    assert len(secret['ice_candidates']) == 2
+    assert _fetch(monkeypatch, secret)['peer_id'] == secret['peer_id']
+
+    tampered = dict(secret, ice_candidates=[dict(secret['ice_candidates'][0], ip='198.51.100.66')])
+    with pytest.raises(InvalidSignature):
+        _fetch(monkeypatch, tampered)
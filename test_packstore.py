@@ -0,0 +1,129 @@
+import os
+import threading
+import pytest
+from packstore import PackStore, QuotaExceeded
+
+def test_small_and_large_objects(tmp_path):
+    store = PackStore(tmp_path, small_limit=16)
+    store.put('small', b'hello')
+    store.put('large', b'x' * 100)
+    assert store.get('small') == b'hello'
+    assert store.get('large') == b'x' * 100
+    assert store.locate('small')[0].parent == tmp_path / 'packs'
+    assert store.locate('large')[0].parent.parent == tmp_path / 'objects'
+    assert sorted(store.names()) == ['large', 'small']
+    store.close()
+
+def test_reopen_keeps_index(tmp_path):
+    store = PackStore(tmp_path)
+    for i in range(2000):
+        store.put(f'obj{i}', str(i).encode())
+    store.close()
+    store = PackStore(tmp_path)
+    assert store.get('obj1234') == b'1234'
+    assert store.used == sum(len(str(i)) for i in range(2000))
+    store.close()
+
+def test_quota_counts_replaced_objects(tmp_path):
+    store = PackStore(tmp_path, quota=10)
+    store.put('a', b'12345678')
+    with pytest.raises(QuotaExceeded):
+        store.put('b', b'123')
+    store.put('a', b'1234567890')
+    assert store.get('a') == b'1234567890'
+    store.close()
+
+def test_compact_drops_dead_records(tmp_path):
+    store = PackStore(tmp_path, pack_limit=1024)
+    for i in range(200):
+        store.put(f'obj{i}', b'y' * 20)
+    for i in range(150):
+        store.delete(f'obj{i}')
+    assert store.compact() > 0
+    assert 'obj10' not in store
+    assert store.get('obj199') == b'y' * 20
+    assert len(list(store.names())) == 50
+    store.close()
+
+def test_torn_record_is_cut_from_active_pack(tmp_path):
+    store = PackStore(tmp_path)
+    store.put('a', b'first')
+    store.close()
+    pack = tmp_path / 'packs' / 'pack-000001.dat'
+    with open(pack, 'ab') as f:
+        f.write(b'PKR1\x05\x00')  # crash in the middle of a record header
+    store = PackStore(tmp_path)
+    store.put('b', b'second')
+    assert sorted(store.names()) == ['a', 'b']
+    store.close()
+    store = PackStore(tmp_path)
+    assert store.get('b') == b'second'
+    store.close()
+
+def test_missing_sealed_pack_is_not_recreated(tmp_path):
+    store = PackStore(tmp_path, pack_limit=64)
+    store.put('a', b'x' * 40)
+    store.put('b', b'y' * 40)
+    sealed = tmp_path / 'packs' / 'pack-000001.dat'
+    os.close(store._pack_fds.pop(1))
+    sealed.unlink()
+    with pytest.raises(FileNotFoundError):
+        store.get('a')
+    assert not sealed.exists()
+    store.close()
+
+def test_compact_keeps_pack_with_unscanned_live_records(tmp_path, monkeypatch):
+    store = PackStore(tmp_path, pack_limit=64)
+    store.put('a', b'x' * 20)
+    store.put('c', b'z' * 20)
+    store.put('b', b'y' * 40)
+    store.delete('a')
+    monkeypatch.setattr(store, '_scan_pack', lambda pack: iter(()))
+    assert store.compact(dead_ratio=0.1) == 0
+    assert store.get('c') == b'z' * 20
+    store.close()
+
+def test_store_is_opened_once(tmp_path):
+    store = PackStore(tmp_path)
+    with pytest.raises(RuntimeError, match='already open'):
+        PackStore(tmp_path)
+    store.close()
+    PackStore(tmp_path).close()
+
+def test_compactor_survives_failures(tmp_path):
+    store = PackStore(tmp_path)
+    calls = []
+    done = threading.Event()
+
+    def compact():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError('Corrupt record')
+        done.set()
+        return 0
+
+    store.compact = compact
+    store.start_compactor(interval=0.01)
+    assert done.wait(5)
+    store.close()
+    assert len(calls) >= 2
+
+def test_namespace_quotas(tmp_path):
+    store = PackStore(tmp_path, small_limit=16)
+    store.namespace_quotas['r1'] = 100
+    store.put('r1/a', b'x' * 60)
+    store.put('r1/b', b'y' * 10)
+    store.put('r2/a', b'z' * 200)
+    with pytest.raises(QuotaExceeded, match='for r1'):
+        store.put('r1/c', b'w' * 40)
+    store.put('r1/a', b'x' * 90)  # replacing frees the old bytes
+    store.delete('r1/b')
+    store.put('r1/c', b'w' * 10)
+    store.close()
+
+    store = PackStore(tmp_path, small_limit=16)
+    assert store._namespace_used == {'r1': 100, 'r2': 200}
+    store.namespace_quotas['r1'] = 100
+    with pytest.raises(QuotaExceeded):
+        store.put('r1/d', b'v')
+    store.close()
@@ -0,0 +1,88 @@
+def _register(api, client_id, space):
+    response = api.post('/register', json={'id': client_id, 'endpoint': f'{client_id}:1', 'available_space': space})
+    assert response.status_code == 201
+
+def test_offers_etag_depends_on_query(api):
+    _register(api, 'a', 50)
+    _register(api, 'b', 100)
+    full = api.get('/offers')
+    assert [p['id'] for p in full.json()] == ['a', 'b']
+    etag = full.headers['ETag']
+    assert api.get('/offers', headers={'If-None-Match': etag}).status_code == 304
+
+    filtered = api.get('/offers', params={'min_space': 60}, headers={'If-None-Match': etag})
+    assert filtered.status_code == 200
+    assert [p['id'] for p in filtered.json()] == ['b']
+    assert filtered.headers['ETag'] != etag
+    delta = api.get('/offers', params={'since': 0}, headers={'If-None-Match': etag})
+    assert delta.status_code == 200
+
+    _register(api, 'c', 10)
+    assert api.get('/offers', headers={'If-None-Match': etag}).status_code == 200
+
+def test_offers_since_returns_changes_and_removals(api):
+    _register(api, 'a', 50)
+    _register(api, 'b', 100)
+    first = api.get('/offers', params={'since': 0})
+    assert first.json()['version'] == 2
+    assert [p['id'] for p in first.json()['changed']] == ['a', 'b']
+    again = api.get('/offers', params={'since': 2}, headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+    _register(api, 'c', 70)
+    assert api.delete('/register/a').status_code == 200
+    delta = api.get('/offers', params={'since': 2}).json()
+    assert delta == {
+        'version': 4, 'reset': False, 'removed': ['a'],
+        'changed': [{'id': 'c', 'endpoint': 'c:1', 'free_space': 70}],
+    }
+    # Peers below the filter are reported as removed
+    filtered = api.get('/offers', params={'since': 0, 'min_space': 80}).json()
+    assert [p['id'] for p in filtered['changed']] == ['b']
+    assert sorted(filtered['removed']) == ['a', 'c']
+
+def test_offers_reset_when_client_is_ahead(api):
+    _register(api, 'a', 50)
+    delta = api.get('/offers', params={'since': 99}).json()
+    assert delta['reset'] is True
+    assert delta['version'] == 1
+    assert [p['id'] for p in delta['changed']] == ['a']
+    assert delta['removed'] == []
+
+def test_reservations_lists_only_approved_ones_for_the_host(api):
+    _register(api, 'bob', 100)
+    approved = api.post('/reserve', json={'from_id': 'alice', 'to_id': 'bob', 'amount': 20}).json()['reservation_id']
+    api.post('/reserve', json={'from_id': 'carol', 'to_id': 'bob', 'amount': 30})
+    assert api.post(f'/requests/{approved}/approve', json={'secret_info': {}}).status_code == 200
+    assert api.get('/reservations', params={'for': 'bob'}).json() == [
+        {'reservation_id': approved, 'from_id': 'alice', 'amount': 20},
+    ]
+    assert api.get('/reservations', params={'for': 'alice'}).json() == []
+
+def _reservation_with_object(api, leaves=3):
+    _register(api, 'bob', 100)
+    rid = api.post('/reserve', json={'from_id': 'alice', 'to_id': 'bob', 'amount': 20}).json()['reservation_id']
+    obj = {'name': 'a.bin', 'root': '00' * 32, 'leaves': leaves, 'size': 4096 * leaves}
+    response = api.post(f'/reservations/{rid}/objects', json={'requester': 'alice', 'objects': [obj]})
+    return rid, response
+
+def test_challenge_requests_are_validated(api):
+    rid, response = _reservation_with_object(api, leaves=0)
+    assert response.status_code == 422
+    assert api.post(f'/reservations/{rid}/objects', json={'requester': 'alice', 'objects': [
+        {'name': 'a.bin', 'root': '00' * 32, 'leaves': 3, 'size': 3 * 4096},
+    ]}).status_code == 200
+    for count in (0, -1, 101):
+        assert api.post('/challenges', json={'reservation_id': rid, 'count': count}).status_code == 422
+    assert len(api.post('/challenges', json={'reservation_id': rid, 'count': 100}).json()) == 100
+
+def test_unanswered_challenges_expire(api, monkeypatch):
+    import server
+    rid, _ = _reservation_with_object(api)
+    monkeypatch.setattr(server, 'CHALLENGE_TTL', -1)
+    cid = api.post('/challenges', json={'reservation_id': rid}).json()[0]['challenge_id']
+    assert api.get('/challenges', params={'for': 'bob'}).json() == []
+    assert api.get(f'/challenges/{cid}').json()['status'] == 'failed'
+    answer = api.post(f'/challenges/{cid}/answer', json={'leaf': '', 'proof': []})
+    assert answer.status_code == 400
+    assert answer.json()['detail'] == 'Challenge expired'
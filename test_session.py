@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+from session import INITIAL_WINDOW, Session, SessionPool
+
+async def _echo(stream):
+    if stream.header['op'] == 'fail':
+        raise ValueError('boom')
+    data = await stream.read_all()
+    stream.write(data[::-1])
+    await stream.drain()
+
+async def _serve():
+    async def handle(reader, writer):
+        session = Session(reader, writer, handler=_echo, initiator=False)
+        await session.wait_closed()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+def test_concurrent_streams_share_one_connection():
+    async def run():
+        server, port = await _serve()
+        async with server:
+            pool = SessionPool()
+            connects = []
+
+            def connect():
+                connects.append(port)
+                return asyncio.open_connection('127.0.0.1', port)
+
+            session = await pool.get('peer', connect)
+            big = bytes(range(256)) * (4 * INITIAL_WINDOW // 256)
+            replies = await asyncio.gather(
+                session.request({'op': 'echo'}, b'small'),
+                session.request({'op': 'echo'}, big),
+                *[(await pool.get('peer', connect)).request({'op': 'echo'}, b'%d' % i) for i in range(20)],
+            )
+            await pool.close_all()
+            return connects, replies, big
+
+    connects, replies, big = asyncio.run(run())
+    assert len(connects) == 1
+    assert replies[0] == b'llams'
+    assert replies[1] == big[::-1]
+    assert replies[2 + 13] == b'31'
+
+def test_handler_error_resets_only_that_stream():
+    async def run():
+        server, port = await _serve()
+        async with server:
+            session = Session(*await asyncio.open_connection('127.0.0.1', port))
+            with pytest.raises(ConnectionError, match='boom'):
+                await session.request({'op': 'fail'})
+            reply = await session.request({'op': 'echo'}, b'ok')
+            await session.close()
+            return reply
+
+    assert asyncio.run(run()) == b'ko'
@@ -0,0 +1,328 @@
+import asyncio
+import time
+from unittest.mock import Mock
+import pytest
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+import p2p_ops
+import transfer
+from p2p_ops import HostedReservations, _handle_stream, authenticate
+from packstore import PackStore
+from session import Session
+from transfer import CHUNK_SIZE, download, iter_files, object_name, receive_files, send_files
+
+def test_directory_batch_over_one_connection(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    for i in range(300):
+        (src / f'f{i}.txt').write_bytes(f'file {i}'.encode())
+    (src / 'sub' / 'big.bin').write_bytes(b'z' * 1_000_000)
+    store = PackStore(tmp_path / 'host')
+    store.sync = Mock(wraps=store.sync)
+    connections = []
+
+    async def run():
+        async def handle(reader, writer):
+            connections.append(writer)
+            await receive_files(reader, writer, store, 'rid')
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            result = await send_files(reader, writer, iter_files([src]))
+            writer.close()
+            return result
+
+    count, total = asyncio.run(run())
+    assert count == 301
+    assert total == sum(len(f'file {i}') for i in range(300)) + 1_000_000
+    assert len(connections) == 1
+    store.sync.assert_called_once()
+    assert store.get('rid/src/f42.txt') == b'file 42'
+    assert store.get('rid/src/sub/big.bin') == b'z' * 1_000_000
+    store.close()
+
+def test_quota_error_is_reported(tmp_path):
+    src = tmp_path / 'a.bin'
+    src.write_bytes(b'a' * 100)
+    store = PackStore(tmp_path / 'host', quota=10)
+
+    async def run():
+        async def handle(reader, writer):
+            await receive_files(reader, writer, store, 'rid')
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                await send_files(reader, writer, iter_files([src]))
+            finally:
+                writer.close()
+
+    with pytest.raises(ConnectionError, match='quota'):
+        asyncio.run(run())
+    store.close()
+
+def test_reservations_get_separate_namespaces(tmp_path):
+    store = PackStore(tmp_path / 'host')
+
+    async def upload(reservation_id, data):
+        src = tmp_path / reservation_id / 'report.pdf'
+        src.parent.mkdir()
+        src.write_bytes(data)
+
+        async def handle(reader, writer):
+            await receive_files(reader, writer, store, reservation_id)
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+            await send_files(reader, writer, iter_files([src]))
+            writer.close()
+
+    asyncio.run(upload('rid1', b'first'))
+    asyncio.run(upload('rid2', b'second'))
+    assert store.get('rid1/report.pdf') == b'first'
+    assert store.get('rid2/report.pdf') == b'second'
+    for reservation_id, name in [(None, 'a'), ('a/b', 'c'), ('rid1', '\0merkle/report.pdf')]:
+        with pytest.raises(PermissionError):
+            object_name(reservation_id, name)
+    store.close()
+
+def _hosted(*reservation_ids):
+    reservations = HostedReservations('bob', 'http://server', Ed25519PrivateKey.generate())
+    reservations.amounts = {rid: 100 for rid in reservation_ids}
+    reservations._refreshed = time.monotonic()
+    return reservations
+
+async def _host_session(store, reservations, reservation_id='rid'):
+    """Serve `store` on a local port; return (server, authenticated client session)."""
+    async def handle(reader, writer):
+        handler = lambda stream: _handle_stream(store, stream, reservations=reservations)
+        await Session(reader, writer, handler=handler, initiator=False).wait_closed()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    session = Session(*await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1]))
+    if reservation_id in reservations.amounts:
+        await authenticate(session, reservation_id, reservations.key(reservation_id))
+    return server, session
+
+def _retrieve(store, tmp_path, name, reservation_id='rid', **kwargs):
+    async def run():
+        server, session = await _host_session(store, _hosted('rid'), reservation_id)
+        async with server:
+            received = await download(session, reservation_id, name, tmp_path / 'out', **kwargs)
+            await session.close()
+            return received
+
+    received = asyncio.run(run())
+    return received, (tmp_path / 'out').read_bytes()
+
+def test_download_whole_object_in_concurrent_ranges(tmp_path):
+    data = bytes(range(256)) * 40_000
+    store = PackStore(tmp_path / 'host')
+    store.put('rid/archive.tar', data)
+    received, out = _retrieve(store, tmp_path, 'archive.tar', range_size=1_000_000)
+    assert received == len(data)
+    assert out == data
+    store.close()
+
+def test_download_range_of_packed_object(tmp_path):
+    store = PackStore(tmp_path / 'host')
+    store.put('rid/other', b'-' * 50)
+    store.put('rid/notes.txt', b'0123456789' * 10)
+    received, out = _retrieve(store, tmp_path, 'notes.txt', offset=25, length=10)
+    assert received == 10
+    assert out == b'5678901234'
+    store.close()
+
+def test_reads_are_confined_to_the_reservation(tmp_path):
+    store = PackStore(tmp_path / 'host')
+    store.put('rid/big', bytes(range(256)) * 64)
+    store.put('other/secret', b'not yours')
+    with pytest.raises(ConnectionError, match='No such object'):
+        _retrieve(store, tmp_path, 'secret')
+    with pytest.raises(ConnectionError, match='Invalid object name'):
+        _retrieve(store, tmp_path, '\0merkle/rid/big')
+    with pytest.raises(ConnectionError, match='not authenticated'):
+        _retrieve(store, tmp_path, 'big', reservation_id=None)
+    with pytest.raises(ConnectionError, match='not authenticated'):
+        _retrieve(store, tmp_path, 'secret', reservation_id='other')
+    store.close()
+
+def test_failed_upload_resets_stream_and_aborts_host_write(tmp_path, monkeypatch):
+    src = tmp_path / 'big.bin'
+    src.write_bytes(b'x' * (3 * CHUNK_SIZE))
+    store = PackStore(tmp_path / 'host')
+    read_chunk = transfer._read_chunk
+    reads = []
+
+    def failing_read(f, n, tree):
+        if reads:
+            raise OSError('disk error')
+        reads.append(n)
+        return read_chunk(f, n, tree)
+
+    async def fetch_peer_secret(*args):
+        return {'peer_id': 'bob'}
+
+    monkeypatch.setattr(transfer, '_read_chunk', failing_read)
+    monkeypatch.setattr(p2p_ops, 'fetch_peer_secret', fetch_peer_secret)
+
+    async def run():
+        reservations = _hosted('rid')
+        server, session = await _host_session(store, reservations)
+        async with server:
+            async def peer_session(*args):
+                return session
+
+            monkeypatch.setattr(p2p_ops, 'peer_session', peer_session)
+            with pytest.raises(OSError, match='disk error'):
+                await p2p_ops.p2p_connect_and_send('rid', 'alice', 0, [src], 'http://server', None)
+            for _ in range(100):
+                if store._pending == 0:
+                    break
+                await asyncio.sleep(0.01)
+            await session.close()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+    assert store._pending == 0
+    assert list((tmp_path / 'host' / 'objects' / 'tmp').iterdir()) == []
+    assert 'rid/big.bin' not in store
+    store.close()
+
+def test_invalid_ranges_are_rejected(tmp_path):
+    store = PackStore(tmp_path / 'host')
+    store.put('rid/before', b'private bytes')
+    store.put('rid/notes.txt', b'0123456789')
+    with pytest.raises(ValueError, match='Invalid byte range'):
+        _retrieve(store, tmp_path, 'notes.txt', length=-5)
+    with pytest.raises(ValueError, match='Invalid byte range'):
+        _retrieve(store, tmp_path, 'notes.txt', offset=-13)
+
+    async def get(header):
+        server, session = await _host_session(store, _hosted('rid'))
+        async with server:
+            try:
+                return await session.request({'op': 'get', 'reservation_id': 'rid', 'name': 'notes.txt', **header})
+            finally:
+                await session.close()
+
+    for header in [{'offset': -13}, {'offset': '1'}, {'length': -1}, {'offset': None}]:
+        with pytest.raises(ConnectionError, match='Invalid byte range'):
+            asyncio.run(get(header))
+    assert asyncio.run(get({'offset': 8})) == b'89'
+    store.close()
+
+def test_failed_range_stops_the_other_fetches(tmp_path, monkeypatch):
+    writes_after_failure = []
+
+    class FakeSession:
+        async def request(self, header):
+            return b'{"size": 4000}'
+
+    async def fetch_range(session, reservation_id, name, offset, length, fd, out_offset):
+        if offset == 0:
+            raise ConnectionError('range failed')
+        await asyncio.sleep(0.1)
+        writes_after_failure.append(offset)
+        return length
+
+    async def run():
+        with pytest.raises(ConnectionError, match='range failed'):
+            await download(FakeSession(), 'rid', 'data', tmp_path / 'out', range_size=1000)
+        await asyncio.sleep(0.2)
+        with pytest.raises(ValueError, match='parallel'):
+            await download(FakeSession(), 'rid', 'data', tmp_path / 'out', parallel=0)
+
+    monkeypatch.setattr(transfer, 'fetch_range', fetch_range)
+    asyncio.run(run())
+    assert writes_after_failure == []
+
+def test_only_approved_reservations_with_the_right_key_are_served(tmp_path, monkeypatch):
+    store = PackStore(tmp_path / 'host')
+    store.put('rid/notes.txt', b'hello')
+    reservations = _hosted('rid')
+    refreshes = []
+
+    async def list_reservations(client_id, server):
+        refreshes.append(client_id)
+        return [{'reservation_id': 'rid', 'from_id': 'alice', 'amount': 1},
+                {'reservation_id': 'late', 'from_id': 'alice', 'amount': 1}]
+
+    monkeypatch.setattr(p2p_ops, 'list_reservations', list_reservations)
+
+    async def run():
+        server, session = await _host_session(store, reservations, reservation_id=None)
+        async with server:
+            with pytest.raises(ConnectionError, match='Wrong proof'):
+                await authenticate(session, 'rid', _hosted().key('rid'))
+            with pytest.raises(ConnectionError, match='Unknown reservation'):
+                await authenticate(session, 'unapproved', reservations.key('unapproved'))
+            assert refreshes == []  # refreshed too recently
+            reservations._refreshed -= p2p_ops.RESERVATIONS_REFRESH_INTERVAL + 1
+            await authenticate(session, 'late', reservations.key('late'))
+            assert refreshes == ['bob']
+            with pytest.raises(ConnectionError, match='not authenticated'):
+                await session.request({'op': 'stat', 'reservation_id': 'rid', 'name': 'notes.txt'})
+            await authenticate(session, 'rid', reservations.key('rid'))
+            reply = await session.request({'op': 'stat', 'reservation_id': 'rid', 'name': 'notes.txt'})
+            await session.close()
+            return reply
+
+    assert asyncio.run(asyncio.wait_for(run(), 10)) == b'{"size": 5}'
+    store.close()
+
+def test_uploads_are_limited_to_the_reservation_amount(tmp_path):
+    src = tmp_path / 'big.bin'
+    src.write_bytes(b'x' * (1024 * 1024 + 1))
+    store = PackStore(tmp_path / 'host')
+    reservations = _hosted('rid')
+    reservations.amounts['rid'] = 1
+
+    async def run():
+        server, session = await _host_session(store, reservations)
+        async with server:
+            stream = await session.open_stream({'op': 'upload', 'reservation_id': 'rid'})
+            try:
+                await send_files(stream, stream, iter_files([src]))
+            finally:
+                await session.close()
+
+    with pytest.raises(ConnectionError, match='quota of 1048576 bytes for rid'):
+        asyncio.run(asyncio.wait_for(run(), 10))
+    assert 'rid/big.bin' not in store
+    store.close()
+
+def test_objects_are_committed_off_the_event_loop(tmp_path, monkeypatch):
+    import threading
+    from packstore import ObjectWriter
+    src = tmp_path / 'big.bin'
+    src.write_bytes(b'x' * (3 * CHUNK_SIZE))
+    store = PackStore(tmp_path / 'host')
+    commit = ObjectWriter.commit
+    threads = []
+
+    def recording_commit(self):
+        threads.append(threading.current_thread())
+        return commit(self)
+
+    monkeypatch.setattr(ObjectWriter, 'commit', recording_commit)
+
+    async def run():
+        server, session = await _host_session(store, _hosted('rid'))
+        async with server:
+            stream = await session.open_stream({'op': 'upload', 'reservation_id': 'rid'})
+            await send_files(stream, stream, iter_files([src]))
+            await session.request({'op': 'put', 'reservation_id': 'rid', 'name': 'small', 'size': 5}, b'hello')
+            await session.close()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+    assert threads and threading.main_thread() not in threads  # includes the Merkle sidecar
+    assert store.get('rid/big.bin') == src.read_bytes()
+    assert store.get('rid/small') == b'hello'
+    store.close()
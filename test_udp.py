@@ -0,0 +1,183 @@
+import asyncio
+import json
+import random
+from unittest.mock import patch
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+import p2p_ops
+import udp
+from p2p import P2PConnection
+from packstore import PackStore
+from session import Session
+from transfer import download
+
+async def _punched_pair(loss=0.0):
+    stun = await udp.start_stun_server('127.0.0.1', 0)
+    endpoints = [await udp.open_endpoint(0, '127.0.0.1') for _ in range(2)]
+    rng = random.Random(1)
+    for ep in endpoints:
+        send = ep.transport.sendto
+
+        def lossy(data, addr, send=send):
+            if rng.random() >= loss:
+                send(data, addr)
+
+        ep.transport.sendto = lossy
+    candidates = [await ep.gather_candidates(stun.get_extra_info('sockname')) for ep in endpoints]
+    token = udp.connection_token('rid')
+    a, b = [ep.connection(token, b'session1') for ep in endpoints]
+    await asyncio.gather(
+        a.punch(udp.candidate_addresses(candidates[1])),
+        b.punch(udp.candidate_addresses(candidates[0])),
+    )
+    return stun, endpoints, a, b
+
+def test_stun_stand_in_reports_mapped_address():
+    async def run():
+        stun = await udp.start_stun_server('127.0.0.1', 0)
+        ep = await udp.open_endpoint(0, '127.0.0.1')
+        mapped = await ep.stun(stun.get_extra_info('sockname'))
+        local = ep.local_address
+        ep.close()
+        stun.close()
+        return mapped, local
+
+    mapped, local = asyncio.run(run())
+    assert mapped == local
+
+def test_session_over_lossy_udp():
+    data = random.Random(2).randbytes(500_000)
+
+    async def echo(stream):
+        stream.write((await stream.read_all())[::-1])
+        await stream.drain()
+
+    async def run():
+        stun, endpoints, a, b = await _punched_pair(loss=0.05)
+        host = Session(b, b, handler=echo, initiator=False)
+        client = Session(a, a)
+        reply = await client.request({'op': 'echo'}, data)
+        await client.close()
+        await host.wait_closed()
+        for ep in endpoints:
+            ep.close()
+        stun.close()
+        return reply, a, b
+
+    reply, a, b = asyncio.run(asyncio.wait_for(run(), 30))
+    assert reply == data[::-1]
+    assert a.closed and b.closed
+
+def test_download_over_udp(tmp_path):
+    store = PackStore(tmp_path / 'host')
+    store.put('rid/blob', b'0123456789' * 20_000)
+
+    reservations = p2p_ops.HostedReservations('bob', 'http://server', Ed25519PrivateKey.generate())
+    reservations.amounts = {'rid': 1}
+
+    async def handler(stream):
+        await p2p_ops._handle_stream(store, stream, reservations=reservations)
+
+    async def run():
+        stun, endpoints, a, b = await _punched_pair()
+        host = Session(b, b, handler=handler, initiator=False)
+        client = Session(a, a)
+        await p2p_ops.authenticate(client, 'rid', reservations.key('rid'))
+        received = await download(client, 'rid', 'blob', tmp_path / 'out', offset=5, length=100_000, range_size=30_000)
+        await client.close()
+        await host.wait_closed()
+        for ep in endpoints:
+            ep.close()
+        stun.close()
+        return received
+
+    assert asyncio.run(asyncio.wait_for(run(), 30)) == 100_000
+    assert (tmp_path / 'out').read_bytes() == (b'0123456789' * 20_000)[5:100_005]
+    store.close()
+
+def test_reconnect_with_new_connection_id_gets_fresh_state(monkeypatch):
+    monkeypatch.setattr(udp, 'IDLE_TIMEOUT', 0.3)
+    monkeypatch.setattr(udp, 'KEEPALIVE_INTERVAL', 0.1)
+
+    async def upper(stream):
+        stream.write((await stream.read_all()).upper())
+        await stream.drain()
+
+    async def run():
+        host = await udp.open_endpoint(0, '127.0.0.1')
+        host_addr = host.local_address
+        token = udp.connection_token('rid')
+        replies = []
+        port = 0
+        for conn_id in (b'session1', b'session2'):
+            # Same port both times; the first requester dies without a FIN
+            requester = await udp.open_endpoint(port, '127.0.0.1')
+            port = requester.local_address[1]
+            a, b = requester.connection(token, conn_id), host.connection(token, conn_id)
+            await asyncio.gather(a.punch([host_addr]), b.punch([requester.local_address]))
+            Session(b, b, handler=upper, initiator=False)
+            client = Session(a, a)
+            replies.append(await client.request({'op': 'upper'}, conn_id * 1000))
+            requester.close()
+            await asyncio.sleep(0)  # let the transport release the port
+        stale = host.connections.get((token, b'session1'))
+        await asyncio.sleep(0.6)
+        remaining = dict(host.connections)
+        host.close()
+        return replies, stale, remaining
+
+    replies, stale, remaining = asyncio.run(asyncio.wait_for(run(), 30))
+    assert replies == [b'SESSION1' * 1000, b'SESSION2' * 1000]
+    assert stale is not None and stale.closed
+    assert remaining == {}
+
+def test_shared_endpoint_closes_with_last_connection():
+    async def run():
+        ep = await udp.shared_endpoint(0, '127.0.0.1')
+        assert await udp.shared_endpoint(0, '127.0.0.1') is ep
+        a = ep.connection(udp.connection_token('r1'), b'conn0001')
+        b = ep.connection(udp.connection_token('r2'), b'conn0002')
+        a.abort()
+        assert not ep.closed
+        b.abort()
+        assert ep.closed
+        assert await udp.shared_endpoint(0, '127.0.0.1') is not ep
+        udp.close_shared_endpoints()
+
+    asyncio.run(run())
+
+def test_host_accepts_successive_udp_sessions_for_one_reservation(tmp_path, monkeypatch):
+    monkeypatch.setattr(p2p_ops, 'UDP_POLL_INTERVAL', 0.05)
+    announcements = []
+
+    async def list_candidates(client_id, server):
+        announced, announcements[:] = list(announcements), []
+        return announced
+
+    async def run():
+        probes = [await udp.open_endpoint(0, '127.0.0.1') for _ in range(2)]
+        host_port, requester_port = [p.local_address[1] for p in probes]
+        for probe in probes:
+            probe.close()
+        await asyncio.sleep(0)
+        store_dir = tmp_path / 'host'
+        serving = asyncio.create_task(p2p_ops.p2p_serve(host_port, store_dir, udp=True, client_id='bob'))
+        secret = {'ice_candidates': [udp.make_candidate('127.0.0.1', host_port, 'host')]}
+
+        async def announce(candidates, connection_id):
+            announcements.append({'reservation_id': 'rid', 'connection_id': connection_id, 'candidates': candidates})
+
+        replies = []
+        for _ in range(2):
+            conn, _ = await P2PConnection(requester_port).open_udp(secret, 'rid', announce=announce)
+            session = Session(conn, conn)
+            replies.append(json.loads(await session.request({'op': 'ping'})))
+            await session.close()
+        serving.cancel()
+        udp.close_shared_endpoints()
+        return replies
+
+    with patch.object(p2p_ops, 'list_candidates', list_candidates), \
+            patch.object(p2p_ops, 'list_challenges', return_value=[]), \
+            patch('p2p.NATTraversal._get_local_ip', return_value='127.0.0.1'):
+        replies = asyncio.run(asyncio.wait_for(run(), 30))
+    assert replies == [{'ok': True}, {'ok': True}]